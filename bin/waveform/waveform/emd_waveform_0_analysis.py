@@ -18,117 +18,147 @@
 
 import os
 import emd
-import h5py
 import logging
 import numpy as np
 
-from emd_waveform_utils import config, load_dataset
+import emd_waveform_cycles
+from emd_waveform_utils import (config, load_dataset, run_parallel, cached_mask_sift,
+                                save_analysis, recording_manifest, AnalysisFile,
+                                blockwise_frequency_transform, timed_stage,
+                                stage_timings, save_stage_timings, analysis_inputs,
+                                analysis_is_current, save_analysis_inputs)
+from emd_waveform_cycles import (compute_cycle_metrics, subset_bounds, cycle_matrix,
+                                 peak_sample, trough_sample, desc_zero_sample,
+                                 asc2desc, peak2trough)
 
 
-def asc2desc(x):
-    """Ascending to Descending ratio ( A / A+D )."""
-    pt = emd.cycles.cf_peak_sample(x, interp=True)
-    tt = emd.cycles.cf_trough_sample(x, interp=True)
-    if (pt is None) or (tt is None):
-        return np.nan
-    asc = pt + (len(x) - tt)
-    desc = tt - pt
-    return asc / len(x)
-
-
-def peak2trough(x):
-    """Peak to trough ratio ( P / P+T )."""
-    des = emd.cycles.cf_descending_zero_sample(x, interp=True)
-    if des is None:
-        return np.nan
-    return des / len(x)
-
+#%% ----------------------------------------------------
+# Main analysis
+
+
+def theta_cycles(theta, IP, IF, IA, speed):
+    """Identify cycles in the theta IMF, compute their metrics and pick the
+    subset of cycles included in further analysis."""
+    C = emd.cycles.Cycles(IP)
+    compute_cycle_metrics(C, {'start_sample': (np.arange(len(C.cycle_vect)), 'start'),
+                              'stop_sample': (theta, 'stop'),
+                              'peak_sample': (theta, peak_sample),
+                              'desc_sample': (theta, desc_zero_sample),
+                              'trough_sample': (theta, trough_sample),
+                              'duration_samples': (theta, 'len'),
+                              'max_amp': (IA, 'max'),
+                              'mean_if': (IF, 'mean'),
+                              'range_if': (IF, 'range'),
+                              'speed': (speed, 'mean'),
+                              'acc': (np.r_[0, np.diff(speed)], 'mean'),
+                              'asc2desc': (theta, asc2desc),
+                              'peak2trough': (theta, peak2trough)})
 
-def compute_range(x):
-    return x.max() - x.min()
+    # Extract included subset of cycles
+    amp_thresh = np.percentile(IA, 25)
+    lo_freq_duration = 1250/4
+    hi_freq_duration = 1250/12
+    conditions = ['is_good==1',
+                  f'duration_samples<{lo_freq_duration}',
+                  f'duration_samples>{hi_freq_duration}',
+                  f'max_amp>{amp_thresh}',
+                  'speed>1']
 
+    C.pick_cycle_subset(conditions)
 
-#%% ----------------------------------------------------
-# Main loop
+    return C
 
 
-for run, run_name in enumerate(config['recordings']):
+def run_analysis(run_name, force=False):
+    """Run the full analysis on a single recording and save the outputs.
 
+    The analysis is skipped if the saved outputs were computed from the same
+    data files, sift options and code unless force is True.
+    """
     logfile = os.path.join(config['analysisdir'], run_name+'.log')
     emd.logger.set_up(prefix=run_name, log_file=logfile)
     logger = logging.getLogger('emd')
 
     logger.info('STARTING: {0}'.format(run_name))
-
-    raw, speed, time, sample_rate = load_dataset(run_name)
+    stage_timings.clear()
 
     # Load sift specification
     conf_file = os.path.join(config['basedir'], 'emd_masksift_CA1_config.yml')
     sift_config = emd.sift.SiftConfig.from_yaml_file(conf_file)
 
-    # Run sift
-    imf, mf = emd.sift.mask_sift(raw, **sift_config)
-
-    # Frequency Transform
-    IP, IF, IA = emd.spectra.frequency_transform(imf, sample_rate, 'hilbert', smooth_phase=3)
+    # Check whether the saved outputs are up to date
+    inputs = analysis_inputs(run_name, sift_config, __file__, emd_waveform_cycles.__file__)
+    hdf5file = os.path.join(config['analysisdir'], run_name + '.hdf5')
+    csvfile = os.path.join(config['analysisdir'], run_name + '.csv')
+    if force is False and analysis_is_current(hdf5file, inputs) and os.path.isfile(csvfile):
+        logger.info('Outputs are up to date, skipping: {0}'.format(run_name))
+        return
 
-    # Compute cycle statistics
-    C = emd.cycles.Cycles(IP[:, 5])
-    C.compute_cycle_metric('start_sample', np.arange(len(C.cycle_vect)), emd.cycles.cf_start_value)
-    C.compute_cycle_metric('stop_sample', imf[:, 5], emd.cycles.cf_end_value)
-    C.compute_cycle_metric('peak_sample', imf[:, 5], emd.cycles.cf_peak_sample)
-    C.compute_cycle_metric('desc_sample', imf[:, 5], emd.cycles.cf_descending_zero_sample)
-    C.compute_cycle_metric('trough_sample', imf[:, 5], emd.cycles.cf_trough_sample)
-    C.compute_cycle_metric('duration_samples', imf[:, 5], len)
+    with timed_stage('load'):
+        raw, speed, time, sample_rate = load_dataset(run_name)
 
-    C.compute_cycle_metric('max_amp', IA[:, 5], np.max)
-    C.compute_cycle_metric('mean_if', IF[:, 5], np.mean)
-    C.compute_cycle_metric('range_if', IF[:, 5], compute_range)
-    C.compute_cycle_metric('speed', speed, np.mean)
-    C.compute_cycle_metric('acc', np.r_[0, np.diff(speed)], np.mean)
+    # Run sift
+    with timed_stage('sift'):
+        imf, mf = cached_mask_sift(raw, sift_config)
 
-    C.compute_cycle_metric('asc2desc', imf[:, 5], asc2desc)
-    C.compute_cycle_metric('peak2trough', imf[:, 5], peak2trough)
+    # Save time-series and run the frequency transform block-wise straight
+    # into the output file, only the theta IMF is read back for the metrics
+    outfile = os.path.join(config['analysisdir'], run_name + '.hdf5')
+    logger.info('Saving time-series outputs to: {0}'.format(outfile))
+    with timed_stage('save_timeseries'):
+        save_analysis(outfile, {'imf': imf, 'speed': speed})
+    with timed_stage('frequency_transform'):
+        blockwise_frequency_transform(imf, sample_rate, outfile, smooth_phase=3)
 
-    # Extract included subset of cycles
-    amp_thresh = np.percentile(IA[:, 5], 25)
-    lo_freq_duration = 1250/4
-    hi_freq_duration = 1250/12
-    conditions = ['is_good==1',
-                  f'duration_samples<{lo_freq_duration}',
-                  f'duration_samples>{hi_freq_duration}',
-                  f'max_amp>{amp_thresh}',
-                  'speed>1']
+        with AnalysisFile(outfile) as F:
+            IP, IF, IA = F['IP'][:, 5], F['IF'][:, 5], F['IA'][:, 5]
 
-    C.pick_cycle_subset(conditions)
-    df = C.get_metric_dataframe(subset=True)
+    # Compute cycle statistics and extract included subset of cycles
+    with timed_stage('cycle_metrics'):
+        C = theta_cycles(imf[:, 5], IP, IF, IA, speed)
+        df = C.get_metric_dataframe(subset=True)
 
     # phase-aligned waveforms
-    pa, phasex = emd.cycles.phase_align(IP[:, 5], IF[:, 5], C.iterate(through='subset'))
+    with timed_stage('phase_align'):
+        pa, phasex = emd.cycles.phase_align(IP, IF, C.iterate(through='subset'))
 
-    # Compute normalised waveforms
-    norm_waveform, sine = emd.cycles.normalised_waveform(pa)
+        # Compute normalised waveforms
+        norm_waveform, sine = emd.cycles.normalised_waveform(pa)
 
     # ZC-aligned waveforms
-    zc_waveform = np.zeros((313, pa.shape[1]))*np.nan
-    zc_instfreq = np.zeros((313, pa.shape[1]))*np.nan
-    for ii, inds in C.iterate(through='subset'):
-        zc_waveform[:len(inds), ii] = imf[inds, 5]
-        zc_instfreq[:len(inds), ii] = IF[inds, 5]
+    with timed_stage('zc_align'):
+        starts, stops = subset_bounds(C)
+        zc_waveform, _ = cycle_matrix(imf[:, 5], starts, stops, max_len=313)
+        zc_instfreq, _ = cycle_matrix(IF, starts, stops, max_len=313)
 
     # Save output
-    outfile = os.path.join(config['analysisdir'], run_name + '.csv')
-    logger.info('Saving cycle-stats to: {0}'.format(outfile))
-    df.to_csv(outfile)
+    with timed_stage('save_cycles'):
+        outfile = os.path.join(config['analysisdir'], run_name + '.csv')
+        logger.info('Saving cycle-stats to: {0}'.format(outfile))
+        df.to_csv(outfile)
+
+        outfile = os.path.join(config['analysisdir'], run_name + '.hdf5')
+        logger.info('Saving cycle outputs to: {0}'.format(outfile))
+        to_save = {'pa': pa, 'norm_waveform': norm_waveform,
+                   'zc_waveform': zc_waveform, 'zc_instfreq': zc_instfreq}
+        save_analysis(outfile, to_save, mode='a')
+        save_analysis_inputs(outfile, inputs)
+
+    outfile = os.path.join(config['analysisdir'], run_name + '_timings.json')
+    logger.info('Saving stage timings to: {0}'.format(outfile))
+    save_stage_timings(outfile, run_name=run_name, nsamples=raw.shape[0])
 
-    outfile = os.path.join(config['analysisdir'], run_name + '.hdf5')
-    logger.info('Saving time-series outputs to: {0}'.format(outfile))
-    out = h5py.File(outfile, 'w')
+    logger.info('Processing Completed')
 
-    to_save = ['imf', 'IP', 'IF', 'IA', 'speed',
-               'pa', 'norm_waveform', 'zc_waveform', 'zc_instfreq']
-    for key in to_save:
-        out.create_dataset(key, data=locals()[key])
-    out.close()
 
-    logger.info('Processing Completed')
+#%% ----------------------------------------------------
+# Main loop - recordings are independent so can be run in parallel by setting
+# config['nworkers'] in emd_waveform_utils.py. The longest recordings are
+# started first so that they do not hold up the end of the run. Recordings
+# whose outputs are already up to date are skipped.
+
+
+if __name__ == '__main__':
+    manifest = recording_manifest()
+    run_names = sorted(config['recordings'], key=lambda r: manifest[r]['duration'], reverse=True)
+    run_parallel(run_analysis, [(run_name,) for run_name in run_names])
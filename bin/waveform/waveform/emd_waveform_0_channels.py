@@ -0,0 +1,112 @@
+#!/usr/bin/python
+
+# vim: set expandtab ts=4 sw=4:
+
+#%% -----------------------------------------------------
+#
+# This script runs the mask sift and frequency transform on many channels of
+# each recording rather than the single channel used in the main analysis. The
+# channels of a recording are loaded once and shared with worker processes
+# which each sift one channel. Outputs are saved into a single HDF5 file per
+# recording with channels along the last axis of each array.
+
+
+#%% -----------------------------------------------------
+# Imports and definitions
+
+
+import os
+import emd
+import h5py
+import logging
+import numpy as np
+
+from emd_waveform_utils import (config, load_dataset, run_parallel,
+                                SharedArrays, attach_shared_arrays, save_channel_outputs,
+                                blockwise_frequency_transform)
+
+
+#%% ----------------------------------------------------
+# Main analysis
+
+
+def run_channel(ind, channel, data_specs, sample_rate, sift_config):
+    """Sift and frequency transform one channel of a shared recording.
+
+    IMFs are NaN padded to max_imfs so that every channel has the same shape
+    even if its sift stopped early. The sift is not cached as the IMFs of every
+    channel would push the main analysis sifts out of the cache.
+    """
+    logger = logging.getLogger('emd')
+    logger.info('STARTING: channel {0}'.format(channel))
+
+    # The sift is run in float64 and the IMFs stored with config['dtype']
+    raw = np.asarray(attach_shared_arrays(data_specs)['raw'][:, ind], dtype=float)
+    opts = {key: sift_config[key] for key in sift_config if key != 'ret_mask_freq'}
+    imf, mf = emd.sift.mask_sift(raw, ret_mask_freq=True, **opts)
+    imf = imf.astype(config['dtype'], copy=False)
+    IP, IF, IA = blockwise_frequency_transform(imf, sample_rate, smooth_phase=3)
+
+    outputs = {'imf': imf, 'IP': IP, 'IF': IF, 'IA': IA}
+    nimfs = sift_config['max_imfs'] or imf.shape[1]
+    for key, data in outputs.items():
+        padded = np.full((data.shape[0], nimfs), np.nan, dtype=data.dtype)
+        padded[:, :data.shape[1]] = data
+        outputs[key] = padded
+    outputs['mask_freqs'] = np.asarray(mf, dtype=float)
+
+    return outputs
+
+
+def run_channels(run_name, channels=None):
+    """Run the sift on several channels of one recording and save the outputs.
+
+    Channels are processed in batches of config['nworkers'] so that only one
+    batch of outputs is held in memory before it is written to disk. The raw
+    int16 samples are shared with the workers and each channel is converted to
+    float as it is sifted.
+    """
+    logfile = os.path.join(config['analysisdir'], run_name+'_channels.log')
+    emd.logger.set_up(prefix=run_name, log_file=logfile)
+    logger = logging.getLogger('emd')
+
+    logger.info('STARTING: {0}'.format(run_name))
+
+    if channels is None:
+        channels = np.arange(config['nchannels'])
+    channels = np.atleast_1d(channels)
+
+    raw, speed, time, sample_rate = load_dataset(run_name, channels=channels, dtype=np.int16)
+
+    # Load sift specification
+    conf_file = os.path.join(config['basedir'], 'emd_masksift_CA1_config.yml')
+    sift_config = emd.sift.SiftConfig.from_yaml_file(conf_file)
+
+    outfile = os.path.join(config['analysisdir'], run_name + '_channels.hdf5')
+    logger.info('Saving channel outputs to: {0}'.format(outfile))
+
+    batch_size = max(config['nworkers'], 1)
+    shared = SharedArrays(raw=raw)
+    del raw
+    with shared, h5py.File(outfile, 'w') as out:
+        out.create_dataset('channels', data=channels)
+        out.create_dataset('speed', data=speed)
+
+        for bstart in range(0, len(channels), batch_size):
+            inds = range(bstart, min(bstart + batch_size, len(channels)))
+            jobs = [(ind, channels[ind], shared.specs, sample_rate, sift_config) for ind in inds]
+            for ind, outputs in zip(inds, run_parallel(run_channel, jobs)):
+                save_channel_outputs(out, ind, outputs, len(channels))
+
+    logger.info('Processing Completed')
+
+
+#%% ----------------------------------------------------
+# Main loop - channels within each recording are run in parallel by setting
+# config['nworkers'] in emd_waveform_utils.py. Note that each sift may also
+# start 'nprocesses' workers of its own.
+
+
+if __name__ == '__main__':
+    for run_name in config['recordings']:
+        run_channels(run_name)
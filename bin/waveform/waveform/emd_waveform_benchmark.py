@@ -0,0 +1,148 @@
+#!/usr/bin/python
+
+# vim: set expandtab ts=4 sw=4:
+
+#%% -----------------------------------------------------
+#
+# This script benchmarks each stage of the main analysis in
+# emd_waveform_0_analysis.py on simulated recordings of increasing duration.
+# The wall time and peak memory allocated by each stage are saved into the
+# analysis directory so that changes in speed and scaling with recording
+# length can be tracked over time.
+
+
+#%% -----------------------------------------------------
+# Imports and definitions
+
+
+import os
+import time
+import emd
+import logging
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas
+import matplotlib.pyplot as plt
+
+from emd_waveform_utils import (config, load_eeg, blockwise_frequency_transform,
+                                save_analysis)
+from emd_waveform_0_analysis import theta_cycles
+
+
+def simulate_recording(seconds, sample_rate=1250, seed=42):
+    """Simulate a non-sinusoidal theta oscillation with 1/f-like noise, scaled
+    to the range of the int16 LFP recordings."""
+    x = emd.simulate.ar_oscillator(8, sample_rate, seconds, r=.99, random_seed=seed)[:, 0]
+    x = x / x.std()
+    x = x + .25 * x**2
+    rng = np.random.default_rng(seed)
+    x = x + np.cumsum(rng.standard_normal(x.shape)) * .01 + rng.standard_normal(x.shape) * .1
+    return (x / np.abs(x).max() * 2**13).astype(np.int16)
+
+
+def measure(func, *args, **kwargs):
+    """Run func and return its output, wall time in seconds and the peak
+    memory in bytes allocated while it was running. Memory used by worker
+    processes, such as those started by the sift, is not included."""
+    tracemalloc.start()
+    tic = time.perf_counter()
+    out = func(*args, **kwargs)
+    toc = time.perf_counter()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return out, toc - tic, peak
+
+
+def run_benchmark(seconds, sift_config, outdir, sample_rate=1250):
+    """Time each analysis stage on a simulated recording of a given length."""
+    logger = logging.getLogger('emd')
+    logger.info('STARTING: benchmark of {0} seconds'.format(seconds))
+
+    # Write the simulation to disk in the layout of the raw recordings
+    eeg = os.path.join(outdir, 'benchmark_{0}.eeg'.format(seconds))
+    x = simulate_recording(seconds, sample_rate)
+    np.repeat(x[:, None], config['nchannels'], axis=1).tofile(eeg)
+    speed = np.ones(x.shape) * 5
+
+    results = []
+
+    def stage(name, func, *args, **kwargs):
+        out, wall, peak = measure(func, *args, **kwargs)
+        results.append({'seconds': seconds, 'stage': name, 'wall_time': wall, 'peak_memory': peak})
+        logger.info('Stage {0} took {1:.2f}s with peak memory {2:.1f}MB'.format(name, wall, peak / 1024**2))
+        return out
+
+    raw = stage('load', load_eeg, eeg, 0, nchannels=config['nchannels'], dtype=config['dtype'])
+
+    opts = {key: sift_config[key] for key in sift_config if key != 'ret_mask_freq'}
+    imf = stage('sift', emd.sift.mask_sift, np.asarray(raw, dtype=float), **opts)
+    imf = imf.astype(config['dtype'])
+
+    IP, IF, IA = stage('frequency_transform', blockwise_frequency_transform,
+                       imf, sample_rate, smooth_phase=3)
+
+    C = stage('cycle_metrics', theta_cycles, imf[:, 5], IP[:, 5], IF[:, 5], IA[:, 5], speed)
+
+    pa, phasex = stage('phase_align', emd.cycles.phase_align,
+                       IP[:, 5], IF[:, 5], C.iterate(through='subset'))
+
+    outfile = os.path.join(outdir, 'benchmark_{0}.hdf5'.format(seconds))
+    stage('save', save_analysis, outfile, {'imf': imf, 'IP': IP, 'IF': IF, 'IA': IA,
+                                           'speed': speed, 'pa': pa})
+
+    os.remove(eeg)
+    os.remove(outfile)
+    return results
+
+
+#%% ----------------------------------------------------
+# Main benchmark
+
+
+if __name__ == '__main__':
+
+    # Durations of the simulated recordings in seconds
+    durations = [60, 300, 900, 1800]
+
+    logfile = os.path.join(config['analysisdir'], 'benchmark.log')
+    emd.logger.set_up(prefix='benchmark', log_file=logfile)
+    logger = logging.getLogger('emd')
+
+    # Load sift specification
+    conf_file = os.path.join(config['basedir'], 'emd_masksift_CA1_config.yml')
+    sift_config = emd.sift.SiftConfig.from_yaml_file(conf_file)
+
+    results = []
+    with tempfile.TemporaryDirectory(dir=config['analysisdir']) as outdir:
+        for seconds in durations:
+            results.extend(run_benchmark(seconds, sift_config, outdir))
+
+    df = pandas.DataFrame(results)
+    df['emd_version'] = emd.__version__
+    df['dtype'] = config['dtype']
+    df['date'] = time.strftime('%Y-%m-%d %H:%M:%S')
+
+    # Append to previous runs so that regressions can be seen over time
+    outfile = os.path.join(config['analysisdir'], 'benchmark.csv')
+    logger.info('Saving benchmark results to: {0}'.format(outfile))
+    df.to_csv(outfile, mode='a', header=not os.path.isfile(outfile), index=False)
+
+    print(df.pivot(index='stage', columns='seconds', values='wall_time').round(3))
+
+    #%% ----------------------------------------------------
+    # Scaling figure
+
+    plt.figure(figsize=(10, 4))
+    for ii, key in enumerate(['wall_time', 'peak_memory']):
+        plt.subplot(1, 2, ii+1)
+        for name, stage_df in df.groupby('stage', sort=False):
+            plt.loglog(stage_df['seconds'], stage_df[key], 'o-', label=name)
+        plt.xlabel('Recording duration (seconds)')
+        plt.ylabel('Wall time (seconds)' if key == 'wall_time' else 'Peak memory (bytes)')
+        for tag in ['top', 'right']:
+            plt.gca().spines[tag].set_visible(False)
+    plt.legend(frameon=False)
+
+    outname = os.path.join(config['figdir'], 'emd_benchmark.png')
+    plt.savefig(outname, dpi=300, transparent=True)
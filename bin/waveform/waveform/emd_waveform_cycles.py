@@ -0,0 +1,306 @@
+#!/usr/bin/python
+
+# vim: set expandtab ts=4 sw=4:
+
+#%% -----------------------------------------------------
+#
+# Vectorised cycle metrics shared by the analysis scripts. Rather than calling
+# a python function on every cycle with Cycles.compute_cycle_metric, the
+# metrics here are computed for all cycles at once from the start and stop
+# samples of each cycle.
+
+#%% -----------------------------------------------------
+# Imports and definitions
+
+import logging
+import functools
+import numpy as np
+import pandas
+
+
+def cycle_bounds(cycle_vect):
+    """Return the start and stop sample of every cycle in a cycle vector.
+
+    The boundaries match the slices used by emd.cycles.Cycles so that metrics
+    agree with those from Cycles.compute_cycle_metric.
+    """
+    cycle_vect = np.asarray(cycle_vect).reshape(-1)
+    starts = np.r_[0, np.where(np.diff(cycle_vect) == 1)[0] + 1]
+    stops = np.r_[starts[1:], len(cycle_vect)]
+    return starts, stops
+
+
+def subset_bounds(C):
+    """Return the start and stop sample of every cycle in the subset of C.
+
+    These match the samples returned by C.iterate(through='subset').
+    """
+    cycle_vect = np.asarray(C.cycle_vect).reshape(-1)
+    starts, stops = cycle_bounds(cycle_vect)
+    inds = np.where(np.asarray(C.subset_vect) > -1)[0]
+    # The final slice may run over trailing samples which are not in a cycle
+    last = np.where(cycle_vect > -1)[0][-1] + 1
+    return starts[inds], np.minimum(stops[inds], last)
+
+
+def cycle_matrix(x, starts, stops, max_len=None, fill=np.nan):
+    """Gather cycles of x into the columns of a padded [samples x cycles] matrix.
+
+    Cycles are read with a single fancy-index of x. Cycles longer than max_len
+    are truncated and samples past the end of each cycle are set to fill.
+    Float32 input gives a float32 matrix, anything else float64. Returns the
+    matrix and a boolean mask of the valid samples.
+    """
+    starts = np.asarray(starts, dtype=int)
+    lens = np.asarray(stops, dtype=int) - starts
+    if max_len is None:
+        max_len = lens.max() if len(lens) > 0 else 0
+
+    offsets = np.arange(max_len)[:, None]
+    valid = offsets < lens[None, :]
+    inds = np.where(valid, starts[None, :] + offsets, 0)
+
+    X = x[inds]
+    X = np.asarray(X, dtype=np.result_type(X.dtype, np.float32))
+    mask = valid.reshape(valid.shape + (1,) * (X.ndim - 2))
+    return np.where(mask, X, fill), valid
+
+
+def _array_key(x):
+    """Identify the memory behind an array so that separate views of the same
+    data, such as two evaluations of imf[:, 5], share cached results. Cached
+    arrays are stored alongside their results so the memory is not reused."""
+    return (x.__array_interface__['data'][0], x.shape, x.strides, x.dtype.str)
+
+
+# Reductions which can be computed for all cycles from a segment reduction
+CYCLE_REDUCTIONS = ('start', 'stop', 'len', 'max', 'min', 'sum', 'mean', 'range')
+
+
+def reduce_cycles(x, starts, stops, how, cache=None):
+    """Compute one reduction of x within each cycle.
+
+    how is either one of CYCLE_REDUCTIONS or a function taking a padded
+    [samples x cycles] matrix, such as asc2desc, and returning one value per
+    cycle. cache is an optional dictionary used to share segment reductions and
+    cycle matrices of the same array between several metrics.
+    """
+    if callable(how):
+        return _reduce_cycle_shapes(x, starts, stops, how, cache)
+    if how not in CYCLE_REDUCTIONS:
+        raise ValueError("Unknown cycle reduction '{0}' - use one of {1}".format(how, CYCLE_REDUCTIONS))
+    if cache is None:
+        cache = {}
+    x = np.asarray(x)
+
+    def _segment(ufunc):
+        key = _array_key(x) + (ufunc.__name__,)
+        if key not in cache:
+            cache[key] = (x, ufunc.reduceat(x, starts, axis=0))
+        return cache[key][1]
+
+    if how == 'start':
+        return x[starts]
+    elif how == 'stop':
+        return x[stops - 1]
+    elif how == 'len':
+        return stops - starts
+    elif how == 'max':
+        return _segment(np.maximum)
+    elif how == 'min':
+        return _segment(np.minimum)
+    elif how == 'sum':
+        return _segment(np.add)
+    elif how == 'mean':
+        return _segment(np.add) / (stops - starts)
+    elif how == 'range':
+        return _segment(np.maximum) - _segment(np.minimum)
+
+
+def _reduce_cycle_shapes(x, starts, stops, func, cache=None):
+    """Apply a cycle-matrix function to every cycle of x.
+
+    Cycles are gathered in groups of similar length (between successive powers
+    of two) so that the padded matrices are at most twice the size of x.
+    """
+    if cache is None:
+        cache = {}
+    x = np.asarray(x)
+
+    key = _array_key(x) + ('cycle_matrix',)
+    if key not in cache:
+        lens = stops - starts
+        groups = np.ceil(np.log2(np.maximum(lens, 1))).astype(int)
+        matrices = []
+        for group in np.unique(groups):
+            inds = np.where(groups == group)[0]
+            X, _ = cycle_matrix(x, starts[inds], stops[inds], max_len=2**group)
+            matrices.append((inds, X))
+        cache[key] = (x, matrices)
+
+    out = np.zeros((len(starts),)) * np.nan
+    for inds, X in cache[key][1]:
+        out[inds] = func(X)
+    return out
+
+
+def compute_cycle_metrics(C, metrics):
+    """Compute several metrics for all cycles in C in a single pass.
+
+    metrics is a dictionary mapping each metric name to a tuple of
+    (samples, reduction) where reduction is one of CYCLE_REDUCTIONS or a
+    function of a padded cycle matrix (see reduce_cycles). The results are
+    stored in C as with Cycles.compute_cycle_metric.
+    """
+    logger = logging.getLogger('emd')
+    logger.info('Computing cycle metrics: {0}'.format(list(metrics.keys())))
+
+    starts, stops = cycle_bounds(C.cycle_vect)
+    cache = {}
+    for name, (vals, how) in metrics.items():
+        C.add_cycle_metric(name, reduce_cycles(vals, starts, stops, how, cache=cache))
+
+
+#%% -----------------------------------------------------
+# Waveform shape metrics
+#
+# These operate on a matrix of cycles of shape [samples x cycles], padded with
+# NaNs after the end of each cycle (such as zc_waveform). A single 1d cycle
+# may also be passed, in which case a scalar is returned so that the functions
+# can still be used with Cycles.compute_cycle_metric.
+
+
+def _as_cycle_matrix(x):
+    x = np.asarray(x, dtype=float)
+    return x[:, None] if x.ndim == 1 else x, x.ndim == 1
+
+
+def _cycle_lengths(X):
+    return np.sum(~np.isnan(X), axis=0)
+
+
+def _peak_sample(X):
+    """Parabolic-interpolated location of the largest local maximum per column.
+
+    Matches emd.cycles.cf_peak_sample(x, interp=True): only samples strictly
+    greater than both neighbours are extrema and the largest refined peak is
+    returned. Columns without a local maximum are NaN.
+    """
+    if X.shape[0] < 3:
+        return np.zeros((X.shape[1],)) * np.nan
+
+    y0, y1, y2 = X[:-2, :], X[1:-1, :], X[2:, :]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        is_max = (y1 > y0) & (y1 > y2)
+
+        # Parabola through each triplet as in emd.sift.compute_parabolic_extrema
+        a = .5 * y0 - y1 + .5 * y2
+        b = -5/2 * y0 + 4 * y1 - 3/2 * y2
+        c = 3 * y0 - 3 * y1 + y2
+        tp = -b / (2 * a)
+        y_hat = np.where(is_max, tp * b / 2 + c, -np.inf)
+
+    best = np.argmax(y_hat, axis=0)
+    cols = np.arange(X.shape[1])
+    locs = tp[best, cols] - 2 + (best + 1)
+    locs[~is_max.any(axis=0)] = np.nan
+    return locs
+
+
+def peak_sample(x):
+    """Sub-sample index of the peak of each cycle."""
+    X, single = _as_cycle_matrix(x)
+    out = _peak_sample(X)
+    return out[0] if single else out
+
+
+def trough_sample(x):
+    """Sub-sample index of the trough of each cycle."""
+    X, single = _as_cycle_matrix(x)
+    out = _peak_sample(-X)
+    return out[0] if single else out
+
+
+def desc_zero_sample(x):
+    """Sub-sample index of the first descending zero-crossing of each cycle.
+
+    The crossing is linearly interpolated onto the same 1000 point grid used by
+    emd.cycles.cf_descending_zero_sample(x, interp=True).
+    """
+    X, single = _as_cycle_matrix(x)
+    if X.shape[0] < 2:
+        out = np.zeros((X.shape[1],)) * np.nan
+        return out[0] if single else out
+
+    with np.errstate(invalid='ignore'):
+        is_desc = np.diff(np.sign(X), axis=0) == -2
+
+    first = np.argmax(is_desc, axis=0)
+    cols = np.arange(X.shape[1])
+    x0, x1 = X[first, cols], X[first + 1, cols]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frac = np.rint(x0 / (x0 - x1) * 999) / 999
+    out = first + frac
+    out[~is_desc.any(axis=0)] = np.nan
+    return out[0] if single else out
+
+
+def asc2desc(x):
+    """Ascending to Descending ratio ( A / A+D )."""
+    X, single = _as_cycle_matrix(x)
+    nsamples = _cycle_lengths(X)
+    pt = _peak_sample(X)
+    tt = _peak_sample(-X)
+    out = (pt + (nsamples - tt)) / nsamples
+    return out[0] if single else out
+
+
+def peak2trough(x):
+    """Peak to trough ratio ( P / P+T )."""
+    X, single = _as_cycle_matrix(x)
+    out = desc_zero_sample(X) / _cycle_lengths(X)
+    return out[0] if single else out
+
+
+#%% -----------------------------------------------------
+# Shape space
+#
+# The mean vector of a cycle is the average of its phase-aligned instantaneous
+# frequency weighted by a unit vector at each phase, as in
+# emd.cycles.mean_vector. As this is linear the mean vector of a group of
+# cycles is the average of the mean vectors of its cycles.
+
+
+@functools.lru_cache()
+def phase_basis(nphases=48):
+    """Unit vectors at nphases phases evenly spaced from 0 to 2pi."""
+    phase = np.linspace(0, 2*np.pi, nphases)
+    basis = np.cos(phase) + 1j * np.sin(phase)
+    basis.flags.writeable = False
+    return basis
+
+
+def shape_space(pa, labels=None, by=None):
+    """Shape-space mean vectors of cycles or groups of cycles.
+
+    pa is a [phases x cycles] matrix of phase-aligned instantaneous frequency.
+    labels is an optional dictionary or DataFrame of per-cycle labels, such as
+    the recording or a condition, which are included in the output. If by
+    names one or more labels the mean vectors are averaged within each group,
+    otherwise one row is returned per cycle.
+
+    Returns a DataFrame with the labels, the number of cycles and the real and
+    imaginary parts of each mean vector.
+    """
+    mv = phase_basis(pa.shape[0]) @ np.asarray(pa) / pa.shape[0]
+    df = pandas.DataFrame({} if labels is None else labels).reset_index(drop=True)
+    df['ncycles'] = 1
+    df['real'] = mv.real
+    df['imag'] = mv.imag
+
+    if by is None:
+        return df
+    by = [by] if isinstance(by, str) else list(by)
+    return df.groupby(by).agg(ncycles=('ncycles', 'sum'),
+                              real=('real', 'mean'),
+                              imag=('imag', 'mean')).reset_index()
@@ -18,21 +18,12 @@ import sails
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy import signal, stats, ndimage
-from emd_waveform_utils import config
+from emd_waveform_utils import config, cached_mask_sift
+from emd_waveform_cycles import compute_cycle_metrics, asc2desc
 
 import matplotlib
 matplotlib.rc('font', serif=config['fontname'])
 
-def asc2desc(x):
-    """Ascending to Descending ratio ( A / A+D )."""
-    pt = emd.cycles.cf_peak_sample(x, interp=True)
-    tt = emd.cycles.cf_trough_sample(x, interp=True)
-    if (pt is None) or (tt is None):
-        return np.nan
-    asc = pt + (len(x) - tt)
-    desc = tt - pt
-    return asc / len(x)
-
 # %% ---------------------------------------------
 
 # Create 60 seconds of data at 12Hz
@@ -85,17 +76,17 @@ sift_config = {'imf_opts': {'sd_thresh': 5e-2},
                'nphases': 24,
                'mask_step_factor': 2.5}
 
-imf = emd.sift.mask_sift(y, **sift_config)
+imf = cached_mask_sift(y, sift_config)
 IP, IF, IA = emd.spectra.frequency_transform(imf, sample_rate, 'hilbert')
 
 def mode(x):
     return stats.mode(x)[0][0]
 
 C = emd.cycles.Cycles(IP[:, 2])
-C.compute_cycle_metric('max_amp', IA[:, 2], np.max)
-C.compute_cycle_metric('max_if', IF[:, 2], np.max)
+compute_cycle_metrics(C, {'max_amp': (IA[:, 2], 'max'),
+                         'max_if': (IF[:, 2], 'max')})
 C.compute_cycle_metric('state', waveform_vect[:, 0], mode)
-C.compute_cycle_metric('asc2desc', imf[:, 2], asc2desc)
+compute_cycle_metrics(C, {'asc2desc': (imf[:, 2], asc2desc)})
 #C.add_cycle_metric('state', waveform_type)
 
 conditions = ['is_good==1', 'max_amp>0.03', 'max_if<18']
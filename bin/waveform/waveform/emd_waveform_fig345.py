@@ -18,7 +18,8 @@ import sails
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy import signal, stats, ndimage
-from emd_waveform_utils import config
+from emd_waveform_utils import config, cached_mask_sift
+from emd_waveform_cycles import compute_cycle_metrics, asc2desc, peak2trough
 
 import matplotlib
 matplotlib.rc('font', serif=config['fontname'])
@@ -50,11 +51,13 @@ x = emd.utils.ar_simulate(peak_freq, sample_rate, seconds,
 x = x * 1e-5
 t = np.linspace(0, seconds, seconds*sample_rate)
 
-# Apply linear and non-linear equations and add noise
+# Apply linear and non-linear equations and add noise - seeded so that the
+# sift results can be reused from the cache
 
 x_linear_raw = linear_system(x, K=1)
 x_nonlinear_raw = nonlinear_system(x, K=1, eta=2)
 
+np.random.seed(42)
 x_linear = x_linear_raw + np.random.randn(len(t), 1)*2e-2
 x_nonlinear = x_nonlinear_raw + np.random.randn(len(t), 1)*2e-2
 
@@ -71,8 +74,8 @@ sift_config = {'imf_opts': {'sd_thresh': 5e-2},
                'mask_amp_mode': 'ratio_sig',
                'mask_step_factor': 2.5}
 
-imf_linear = emd.sift.mask_sift(x_linear, **sift_config)
-imf_nonlinear = emd.sift.mask_sift(x_nonlinear, **sift_config)
+imf_linear = cached_mask_sift(x_linear, sift_config)
+imf_nonlinear = cached_mask_sift(x_nonlinear, sift_config)
 
 IP_linear, IF_linear, IA_linear = emd.spectra.frequency_transform(imf_linear, sample_rate, 'hilbert')
 IP_nonlinear, IF_nonlinear, IA_nonlinear = emd.spectra.frequency_transform(imf_nonlinear, sample_rate, 'hilbert')
@@ -81,37 +84,17 @@ IP_nonlinear, IF_nonlinear, IA_nonlinear = emd.spectra.frequency_transform(imf_n
 # %% --------------------------------------------------
 # Cycle analysis
 
-def my_range(x):
-    return x.max() - x.min()
-
-def asc2desc(x):
-    """Ascending to Descending ratio ( A / A+D )."""
-    pt = emd.cycles.cf_peak_sample(x, interp=True)
-    tt = emd.cycles.cf_trough_sample(x, interp=True)
-    if (pt is None) or (tt is None):
-        return np.nan
-    asc = pt + (len(x) - tt)
-    desc = tt - pt
-    return asc / len(x)
-
-def peak2trough(x):
-    """Peak to trough ratio ( P / P+T )."""
-    des = emd.cycles.cf_descending_zero_sample(x, interp=True)
-    if des is None:
-        return np.nan
-    return des / len(x)
-
 Cl = emd.cycles.Cycles(IP_linear[:, 2])
-Cl.compute_cycle_metric('max_amp', IA_linear[:, 2], np.max)
-Cl.compute_cycle_metric('max_if', IF_linear[:, 2], np.max)
-Cl.compute_cycle_metric('if_range', IF_linear[:, 2], my_range)
+compute_cycle_metrics(Cl, {'max_amp': (IA_linear[:, 2], 'max'),
+                          'max_if': (IF_linear[:, 2], 'max'),
+                          'if_range': (IF_linear[:, 2], 'range')})
 
 Cn = emd.cycles.Cycles(IP_nonlinear[:, 2])
-Cn.compute_cycle_metric('max_amp', IA_nonlinear[:, 2], np.max)
-Cn.compute_cycle_metric('max_if', IF_nonlinear[:, 2], np.max)
-Cn.compute_cycle_metric('if_range', IF_nonlinear[:, 2], my_range)
-Cn.compute_cycle_metric('asc2desc', imf_nonlinear[:, 2], asc2desc)
-Cn.compute_cycle_metric('peak2trough', imf_nonlinear[:, 2], peak2trough)
+compute_cycle_metrics(Cn, {'max_amp': (IA_nonlinear[:, 2], 'max'),
+                          'max_if': (IF_nonlinear[:, 2], 'max'),
+                          'if_range': (IF_nonlinear[:, 2], 'range'),
+                          'asc2desc': (imf_nonlinear[:, 2], asc2desc),
+                          'peak2trough': (imf_nonlinear[:, 2], peak2trough)})
 
 conditions = ['is_good==1', 'max_amp>0.04', 'if_range<8', 'max_if<18']
 pa_linear, phase_x = emd.cycles.phase_align(IP_linear[:, 2], IF_linear[:, 2],
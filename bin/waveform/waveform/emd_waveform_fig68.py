@@ -14,13 +14,12 @@
 
 import os
 import emd
-import h5py
 import sails
 import pandas
 import numpy as np
 from scipy import ndimage
 import matplotlib.pyplot as plt
-from emd_waveform_utils import config
+from emd_waveform_utils import config, AnalysisFile
 
 import matplotlib
 matplotlib.rc('font', serif=config['fontname'])
@@ -34,13 +33,14 @@ run_name = config['recordings'][2]
 
 datafile = os.path.join(config['analysisdir'], run_name + '.hdf5')
 
-F = h5py.File(datafile, 'r')
+# Time-series are read lazily - only the windows indexed below are loaded
+F = AnalysisFile(datafile)
 sample_rate = 1250
-imf = F['imf'][...]
-IP = F['IP'][...]
-IA = F['IA'][...]
-IF = F['IF'][...]
-speed = F['speed'][...]
+imf = F['imf']
+IP = F['IP']
+IA = F['IA']
+IF = F['IF']
+speed = F['speed']
 
 metricfile = os.path.join(config['analysisdir'], run_name + '.csv')
 df = pandas.read_csv(metricfile)
@@ -13,12 +13,11 @@
 
 import os
 import emd
-import h5py
 import pandas
 import numpy as np
 from matplotlib import cm
 import matplotlib.pyplot as plt
-from emd_waveform_utils import config
+from emd_waveform_utils import config, AnalysisFile
 
 
 def decorate(ax, mode='timex', bottom_row=True):
@@ -63,9 +62,9 @@ run = 2
 run_name = config['recordings'][2]
 
 datafile = os.path.join(config['analysisdir'], run_name + '.hdf5')
-F = h5py.File(datafile, 'r')
+F = AnalysisFile(datafile)
 
-imf = F['imf'][...]
+imf = F['imf']
 C = emd.cycles.Cycles(F['IP'][:, 5])
 
 metricfile = os.path.join(config['analysisdir'], run_name + '.csv')
@@ -0,0 +1,255 @@
+#!/usr/bin/python
+
+# vim: set expandtab ts=4 sw=4:
+
+#%% -----------------------------------------------------
+#
+# Principal components analysis of the phase-aligned instantaneous frequency
+# profiles used in figure 10. The PCA is accumulated from chunks of cycles so
+# that the cycles of every recording do not need to be held in memory at once.
+# The split-half reproducibility of the PCA is computed from the covariance
+# matrices of many random halves of the data at once rather than fitting a
+# separate PCA to each half. The halves are also accumulated chunk by chunk
+# from a memory-mapped file.
+
+#%% -----------------------------------------------------
+# Imports and definitions
+
+import os
+import hashlib
+import logging
+import numpy as np
+
+from emd_waveform_utils import run_parallel
+
+
+def _batched_pca(sums, grams, counts, npcs):
+    """Principal components of several sets of observations at once.
+
+    sums [sets x features], grams [sets x features x features] and counts
+    [sets] are the sum, sum of outer products and number of observations in
+    each set. Returns components [sets x npcs x features] ordered by variance
+    and the proportion of the total variance explained by each. The sign of
+    each component is set so that its largest magnitude loading is positive,
+    as eigh leaves it arbitrary.
+    """
+    means = sums / counts[:, None]
+    cov = grams - counts[:, None, None] * means[:, :, None] * means[:, None, :]
+    cov = cov / (counts[:, None, None] - 1)
+
+    evals, evecs = np.linalg.eigh(cov)
+    evals, evecs = evals[:, ::-1], evecs[:, :, ::-1]
+    evr = evals / evals.sum(axis=1)[:, None]
+
+    components = np.swapaxes(evecs[:, :, :npcs], 1, 2)
+    loc = np.abs(components).argmax(axis=2)[:, :, None]
+    components = components * np.sign(np.take_along_axis(components, loc, axis=2))
+    return components, evr[:, :npcs]
+
+
+def _component_corr(A, B):
+    """Absolute correlation between matching rows of two stacks of components."""
+    A = A - A.mean(axis=-1, keepdims=True)
+    B = B - B.mean(axis=-1, keepdims=True)
+    r = (A * B).sum(axis=-1) / np.sqrt((A**2).sum(axis=-1) * (B**2).sum(axis=-1))
+    return np.abs(r)
+
+
+class IncrementalPCA:
+    """PCA accumulated from chunks of observations.
+
+    Only the sum and sum of outer products of the observations are kept so
+    memory does not grow with the number of observations. Observations are
+    added with partial_fit and the components are computed when first needed
+    afterwards. The attributes follow sails.utils.PCA - components,
+    explained_variance_ratio, data_mean, project_score and, when fitted with
+    from_chunks, scores.
+    """
+
+    def __init__(self, npcs=None):
+        self.npcs = npcs
+        self.nobs = 0
+        self._sum = None
+        self._gram = None
+        self._fit = None
+
+    def partial_fit(self, X):
+        """Add the observations in X [observations x features]."""
+        X = np.asarray(X, dtype=float)
+        if self._sum is None:
+            self._sum = np.zeros((X.shape[1],))
+            self._gram = np.zeros((X.shape[1], X.shape[1]))
+        self.nobs += X.shape[0]
+        self._sum += X.sum(axis=0)
+        self._gram += X.T @ X
+        self._fit = None
+        return self
+
+    def _get_fit(self):
+        if self._fit is None:
+            if self.nobs < 2:
+                raise ValueError('PCA needs at least two observations, got {0}'.format(self.nobs))
+            npcs = self._sum.shape[0] if self.npcs is None else self.npcs
+            components, evr = _batched_pca(self._sum[None, :], self._gram[None, :, :],
+                                           np.array([self.nobs]), npcs)
+            self._fit = (components[0], evr[0])
+        return self._fit
+
+    @property
+    def components(self):
+        return self._get_fit()[0]
+
+    @property
+    def explained_variance_ratio(self):
+        return self._get_fit()[1]
+
+    @property
+    def data_mean(self):
+        return self._sum / self.nobs
+
+    def transform(self, X):
+        """Scores of the observations in X on each component."""
+        return (np.asarray(X, dtype=float) - self.data_mean) @ self.components.T
+
+    def project_score(self, scores):
+        """Project [n x components] scores back into feature space."""
+        return np.dot(scores, self.components)
+
+    @classmethod
+    def from_chunks(cls, chunks, npcs=None):
+        """Fit a PCA with one pass through chunks and compute the scores with
+        a second. chunks is a function returning a new iterator of arrays."""
+        pca = cls(npcs=npcs)
+        for X in chunks():
+            pca.partial_fit(X)
+        pca.scores = np.concatenate([pca.transform(X) for X in chunks()], axis=0)
+        return pca
+
+
+def read_chunks(datafile, rows=None, chunk_size=2**14, preproc=None):
+    """Yield chunks of a memory-mapped [observations x features] .npy file.
+
+    Only the observations in rows are read if given. preproc is an optional
+    function applied to each chunk, it must be defined at module level to be
+    used by split_half_pca with several workers.
+    """
+    data = np.load(datafile, mmap_mode='r')
+    nobs = data.shape[0] if rows is None else len(rows)
+    for start in range(0, nobs, chunk_size):
+        inds = slice(start, start + chunk_size) if rows is None else rows[start:start+chunk_size]
+        X = np.asarray(data[inds], dtype=float)
+        yield X if preproc is None else preproc(X)
+
+
+def split_half_file(outdir, key, first, nsplits, npcs, seed):
+    name = 'splits_{0}_seed{1}_npcs{2}_{3:06d}_{4}.npz'.format(key, seed, npcs, first, nsplits)
+    return os.path.join(outdir, name)
+
+
+def run_split_chunk(first, nsplits, source, totals, ref_components, npcs, seed, outdir, key):
+    """Compute the split-half metrics of splits first:first+nsplits.
+
+    Each split is a random permutation drawn from a generator seeded on
+    (seed, split) so that results do not depend on how the splits are divided
+    between tasks. The sum and Gram matrix of the first half of every split are
+    accumulated in one pass through the chunks of source (the arguments of
+    read_chunks) and those of the second half are found from the totals of the
+    whole dataset minus the first half.
+    """
+    nobs, total_sum, total_gram = totals
+    nfeatures = total_sum.shape[0]
+    half = nobs // 2
+
+    in_first = np.zeros((nsplits, nobs), dtype=bool)
+    mids = np.full((nsplits,), -1)
+    for ii in range(nsplits):
+        perm = np.random.default_rng([seed, first + ii]).permutation(nobs)
+        in_first[ii, perm[:half]] = True
+        if nobs % 2 == 1:
+            # The middle observation is in neither half
+            mids[ii] = perm[half]
+
+    sums = np.zeros((2 * nsplits, nfeatures))
+    grams = np.zeros((2 * nsplits, nfeatures, nfeatures))
+    start = 0
+    for X in read_chunks(**source):
+        stop = start + X.shape[0]
+        for ii in range(nsplits):
+            X1 = X[in_first[ii, start:stop], :]
+            sums[2*ii] += X1.sum(axis=0)
+            grams[2*ii] += X1.T @ X1
+            if start <= mids[ii] < stop:
+                mid = X[mids[ii] - start, :]
+                sums[2*ii+1] -= mid
+                grams[2*ii+1] -= np.outer(mid, mid)
+        start = stop
+    sums[1::2] += total_sum - sums[0::2]
+    grams[1::2] += total_gram - grams[0::2]
+
+    counts = np.full((2 * nsplits,), half)
+    components, evr = _batched_pca(sums, grams, counts, npcs)
+    p1, p2 = components[0::2], components[1::2]
+
+    C = np.zeros((3, npcs, nsplits))
+    C[0] = _component_corr(ref_components[None, :npcs, :], p1).T
+    C[1] = _component_corr(ref_components[None, :npcs, :], p2).T
+    C[2] = _component_corr(p1, p2).T
+
+    outfile = split_half_file(outdir, key, first, nsplits, npcs, seed)
+    np.savez(outfile, C=C, evr=np.stack((evr[0::2].T, evr[1::2].T)))
+    return first
+
+
+def split_half_pca(datafile, ref_components, nsplits, outdir, rows=None, preproc=None,
+                   npcs=10, seed=42, chunk_splits=100, chunk_size=2**14, nworkers=None):
+    """Split-half reproducibility of a PCA across random halves of the data.
+
+    datafile is a .npy file of [observations x features] data which is read in
+    chunks of chunk_size observations, optionally only the observations in rows
+    and with preproc applied to each chunk (see read_chunks). ref_components
+    [components x features] are the components of the PCA of all the data.
+    Splits are run in chunks of chunk_splits across config['nworkers']
+    processes, each of which holds one boolean per observation for each of its
+    splits. Each chunk of splits is saved into outdir as it finishes and reused
+    on a rerun if the data, reference components, seed and number of
+    components are unchanged.
+
+    Returns the absolute correlation of each component [3 x npcs x nsplits]
+    between the reference and first half, reference and second half and the
+    two halves, and the explained variance ratio of each half [2 x npcs x
+    nsplits].
+    """
+    logger = logging.getLogger('emd')
+    os.makedirs(outdir, exist_ok=True)
+
+    source = {'datafile': datafile, 'rows': rows, 'chunk_size': chunk_size, 'preproc': preproc}
+    ref_components = np.asarray(ref_components, dtype=float)
+
+    # Totals of the whole dataset, hashed along with the reference components
+    # to identify splits saved by a previous run
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(ref_components).data)
+    nobs, total_sum, total_gram = 0, 0, 0
+    for X in read_chunks(**source):
+        h.update(np.ascontiguousarray(X).data)
+        nobs += X.shape[0]
+        total_sum = total_sum + X.sum(axis=0)
+        total_gram = total_gram + X.T @ X
+    key = h.hexdigest()[:16]
+
+    chunks = [(f, min(chunk_splits, nsplits - f)) for f in range(0, nsplits, chunk_splits)]
+    todo = [(f, n) for f, n in chunks
+            if os.path.isfile(split_half_file(outdir, key, f, n, npcs, seed)) is False]
+    logger.info('Running {0} of {1} split-half chunks'.format(len(todo), len(chunks)))
+
+    jobs = [(f, n, source, (nobs, total_sum, total_gram), ref_components, npcs, seed, outdir, key)
+            for f, n in todo]
+    run_parallel(run_split_chunk, jobs, nworkers=nworkers)
+
+    C = np.zeros((3, npcs, nsplits))
+    evr = np.zeros((2, npcs, nsplits))
+    for f, n in chunks:
+        with np.load(split_half_file(outdir, key, f, n, npcs, seed)) as chunk:
+            C[:, :, f:f+n] = chunk['C']
+            evr[:, :, f:f+n] = chunk['evr']
+    return C, evr
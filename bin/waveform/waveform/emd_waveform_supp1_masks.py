@@ -15,19 +15,32 @@
 
 import os
 import emd
-import h5py
+import copy
+import json
+import hashlib
 import logging
 import numpy as np
+import matplotlib.pyplot as plt
 
-from emd_waveform_utils import config, load_dataset
+from emd_waveform_utils import (config, load_dataset, cached_mask_sift, run_parallel,
+                                SharedArrays, attach_shared_arrays, code_version)
+from emd_waveform_cycles import compute_cycle_metrics
 
 
-def run_iter(raw, sample_rate, seconds, sift_config):
+def run_iter(raw, speed, sample_rate, seconds, sift_config, use_cache=True):
+    """Run the analysis on the first seconds of raw and return the average
+    phase-aligned IF of the included cycles. The sift is only cached if
+    use_cache is True, jittered masks give a sift which is never reused."""
 
     try:
         # Run sift
-        imf, mf = emd.sift.mask_sift(raw[:sample_rate*seconds], **sift_config)
-    except EMDSiftCovergeError:
+        if use_cache:
+            imf, mf = cached_mask_sift(raw[:sample_rate*seconds], sift_config)
+        else:
+            opts = {key: sift_config[key] for key in sift_config if key != 'ret_mask_freq'}
+            imf, mf = emd.sift.mask_sift(np.asarray(raw[:sample_rate*seconds], dtype=float),
+                                         ret_mask_freq=True, **opts)
+    except emd.support.EMDSiftCovergeError:
         return None
 
     # Frequency Transform
@@ -35,9 +48,9 @@ def run_iter(raw, sample_rate, seconds, sift_config):
 
     # Compute cycle statistics - only those needed to find subset
     C = emd.cycles.Cycles(IP[:, 5])
-    C.compute_cycle_metric('duration_samples', imf[:, 5], len)
-    C.compute_cycle_metric('max_amp', IA[:, 5], np.max)
-    C.compute_cycle_metric('speed', speed, np.mean)
+    compute_cycle_metrics(C, {'duration_samples': (imf[:, 5], 'len'),
+                              'max_amp': (IA[:, 5], 'max'),
+                              'speed': (speed[:sample_rate*seconds], 'mean')})
 
     # Extract included subset of cycles
     amp_thresh = np.percentile(IA[:, 5], 25)
@@ -57,84 +70,163 @@ def run_iter(raw, sample_rate, seconds, sift_config):
     return pa.mean(axis=1)
 
 
+def run_jitter_task(ii, jj, jitter_size, data_specs, sample_rate, seconds,
+                    sift_config, outdir, key, seed=42, max_attempts=10):
+    """Run one jittered-mask iteration and save its result into outdir.
+
+    The raw and speed arrays are attached from shared memory using data_specs
+    (see SharedArrays) rather than being copied into every task. Masks are
+    drawn from a generator seeded on the seed, iteration and jitter size (in
+    parts per million) so that each task is reproducible regardless of the
+    order in which tasks are run or of the other jitter sizes in the sweep. A
+    task which fails to converge is retried with new masks up to max_attempts
+    times.
+    Returns the task indices and whether it succeeded.
+    """
+    logger = logging.getLogger('emd')
+    data = attach_shared_arrays(data_specs)
+    sift_config = copy.deepcopy(sift_config)
+    orig_masks = np.array(sift_config['mask_freqs'])
+    rng = np.random.default_rng([seed, ii, int(round(jitter_size * 1e6))])
+
+    for attempt in range(max_attempts):
+        logger.info('STARTING: Iteration {0} with jitter {1} (attempt {2})'.format(ii+1, jitter_size, attempt+1))
+        jitter = rng.uniform(1-jitter_size, 1+jitter_size, len(orig_masks))
+        sift_config['mask_freqs'] = orig_masks * jitter
+
+        p = run_iter(data['raw'], data['speed'], sample_rate, seconds, sift_config,
+                     use_cache=False)
+        if p is None:
+            logger.info('Iteration failed - trying again with new masks')
+            continue
+
+        np.save(jitter_task_file(outdir, key, ii, jitter_size, seed), p)
+        return ii, jj, True
+
+    logger.warning('Iteration {0} with jitter {1} failed {2} times'.format(ii+1, jitter_size, max_attempts))
+    return ii, jj, False
+
+
+def jitter_sweep_key(raw, speed, sift_config):
+    """Hash the data, sift options and code of a mask-jitter sweep."""
+    opts = {key: sift_config[key] for key in sift_config if key != 'nprocesses'}
+    h = hashlib.sha1(code_version(__file__).encode())
+    h.update(json.dumps(opts, sort_keys=True, default=lambda x: np.asarray(x).tolist()).encode())
+    for x in (raw, speed):
+        h.update(np.ascontiguousarray(x).data)
+    return h.hexdigest()[:16]
+
+
+def jitter_task_file(outdir, key, ii, jitter_size, seed):
+    name = 'iter{0:03d}_jitter{1:g}_seed{2}_{3}.npy'.format(ii, jitter_size, seed, key)
+    return os.path.join(outdir, name)
+
+
+def run_jitter_sweep(raw, speed, sample_rate, seconds, sift_config, niters,
+                     mask_jitters, outdir, seed=42):
+    """Run all jittered-mask iterations in parallel, resuming from any results
+    already saved in outdir for the same data, sift options, jitter and seed.
+    The data are placed in shared memory once and shared by all workers.
+    Returns the phase-aligned IF for each iteration and jitter (NaN for failed
+    iterations) and a list of failed tasks."""
+    logger = logging.getLogger('emd')
+    os.makedirs(outdir, exist_ok=True)
+
+    nsamples = sample_rate * seconds
+    key = jitter_sweep_key(raw[:nsamples], speed[:nsamples], sift_config)
+    with SharedArrays(raw=raw[:nsamples], speed=speed[:nsamples]) as shared:
+        jobs = []
+        for ii in range(niters):
+            for jj in range(len(mask_jitters)):
+                if os.path.isfile(jitter_task_file(outdir, key, ii, mask_jitters[jj], seed)):
+                    continue
+                jobs.append((ii, jj, mask_jitters[jj], shared.specs, sample_rate, seconds,
+                             sift_config, outdir, key, seed))
+        logger.info('Running {0} of {1} mask-jitter iterations'.format(len(jobs), niters*len(mask_jitters)))
+
+        results = run_parallel(run_jitter_task, jobs)
+    failures = [(ii, jj) for ii, jj, success in results if success is False]
+
+    with open(os.path.join(outdir, 'failures.json'), 'w') as f:
+        json.dump(failures, f)
+
+    pas = np.zeros((48, niters, len(mask_jitters))) * np.nan
+    for ii in range(niters):
+        for jj in range(len(mask_jitters)):
+            taskfile = jitter_task_file(outdir, key, ii, mask_jitters[jj], seed)
+            if os.path.isfile(taskfile):
+                pas[:, ii, jj] = np.load(taskfile)
+
+    return pas, failures
+
+
 #%% ----------------------------------------------------
 # Main loop
 
-# Load dataset
-run = 2
-run_name = config['recordings'][run]
+if __name__ == '__main__':
 
-logfile = os.path.join(config['analysisdir'], run_name+'_maskjitter.log')
-emd.logger.set_up(prefix=run_name, log_file=logfile)
-logger = logging.getLogger('emd')
+    # Load dataset
+    run = 2
+    run_name = config['recordings'][run]
 
-logger.info('STARTING: {0}'.format(run_name))
+    logfile = os.path.join(config['analysisdir'], run_name+'_maskjitter.log')
+    emd.logger.set_up(prefix=run_name, log_file=logfile)
+    logger = logging.getLogger('emd')
 
-raw, speed, time, sample_rate = load_dataset(run_name)
+    logger.info('STARTING: {0}'.format(run_name))
 
-# Load sift specification
-conf_file = os.path.join(config['basedir'], 'emd_masksift_CA1_config.yml')
-sift_config = emd.sift.SiftConfig.from_yaml_file(conf_file)
-orig_masks = sift_config['mask_freqs'].copy()
+    raw, speed, time, sample_rate = load_dataset(run_name)
 
-# Specify number of iterations and jitter ranges
-niters = 25
-mask_jitters = [0.1, 0.2, 0.3]
-seconds = 300
+    # Load sift specification
+    conf_file = os.path.join(config['basedir'], 'emd_masksift_CA1_config.yml')
+    sift_config = emd.sift.SiftConfig.from_yaml_file(conf_file)
 
+    # Specify number of iterations and jitter ranges
+    niters = 25
+    mask_jitters = [0.1, 0.2, 0.3]
+    seconds = 300
 
-# Start main analysis
-logger.info('STARTING: sift with original parameters')
-pa_orig = run_iter(raw, sample_rate, seconds, sift_config)
 
-pas = np.zeros((48, niters, len(mask_jitters)))
+    # Start main analysis
+    logger.info('STARTING: sift with original parameters')
+    pa_orig = run_iter(raw, speed, sample_rate, seconds, sift_config)
 
-for ii in range(niters):
-    for jj in range(len(mask_jitters)):
+    # Each iteration is independent so they are run in parallel using
+    # config['nworkers']. Completed iterations are saved and skipped on a rerun.
+    outdir = os.path.join(config['analysisdir'], run_name + '_maskjitter')
+    pas, failures = run_jitter_sweep(raw, speed, sample_rate, seconds, sift_config,
+                                     niters, mask_jitters, outdir)
+    if len(failures) > 0:
+        logger.warning('{0} mask-jitter iterations failed: {1}'.format(len(failures), failures))
 
-        logger.info('STARTING: Iteration {0} of {1} with jitter {2}'.format(ii+1, niters, mask_jitters[jj]))
+    #%% ----------------------------------------------------
+    # Summary Figure
 
-        flag = True
-        while flag:
-            jitter = np.random.uniform(1-mask_jitters[jj], 1+mask_jitters[jj], len(orig_masks))
-            sift_config['mask_freqs'] = orig_masks * jitter
+    phasex = np.linspace(0, 2*np.pi, 48)
+    titles = ['Manuscript Masks', '10% Mask Jitter', '20% Mask Jitter', '30% Mask Jitter']
 
-            p = run_iter(raw, sample_rate, seconds, sift_config)
-            if p is None:
-                logger.info('Iteration failed - trying again with new masks')
-                continue
-            else:
-                flag = False
-                pas[:, ii, jj] = p
+    plt.figure(figsize=(12,6))
 
-#%% ----------------------------------------------------
-# Summary Figure
-
-phasex = np.linspace(0, 2*np.pi, 48)
-titles = ['Manuscript Masks', '10% Mask Jitter', '20% Mask Jitter', '30% Mask Jitter']
-
-plt.figure(figsize=(12,6))
-
-plt.subplot(141)
-plt.plot(phasex, pa_orig, 'k', linewidth=2)
-plt.ylim(7, 11)
-plt.xticks(np.linspace(0, 2*np.pi, 5), ['0', 'pi/2', 'pi', '3pi/2', '2pi'])
-for tag in ['top', 'right']:
-    plt.gca().spines[tag].set_visible(False)
-plt.title(titles[0])
-plt.ylabel('Instantaneous Frequency (Hz)')
-
-for ii in range(3):
-    plt.subplot(1, 4, ii+2)
-    plt.plot(phasex, pas[:,:,ii], color=[0.6, 0.6, 0.6], linewidth=0.5)
-    plt.plot(phasex, pas[:,:,ii].mean(axis=1), 'k', linewidth=2)
+    plt.subplot(141)
+    plt.plot(phasex, pa_orig, 'k', linewidth=2)
     plt.ylim(7, 11)
-    plt.gca().set_yticklabels([])
     plt.xticks(np.linspace(0, 2*np.pi, 5), ['0', 'pi/2', 'pi', '3pi/2', '2pi'])
     for tag in ['top', 'right']:
         plt.gca().spines[tag].set_visible(False)
-    plt.title(titles[ii+1])
-    plt.xlabel('Theta Phase (rads)')
-
-outname = os.path.join(config['figdir'], 'emd_supp1_maskjitter.png')
-plt.savefig(outname, dpi=300, transparent=True)
+    plt.title(titles[0])
+    plt.ylabel('Instantaneous Frequency (Hz)')
+
+    for ii in range(3):
+        plt.subplot(1, 4, ii+2)
+        plt.plot(phasex, pas[:,:,ii], color=[0.6, 0.6, 0.6], linewidth=0.5)
+        plt.plot(phasex, np.nanmean(pas[:,:,ii], axis=1), 'k', linewidth=2)
+        plt.ylim(7, 11)
+        plt.gca().set_yticklabels([])
+        plt.xticks(np.linspace(0, 2*np.pi, 5), ['0', 'pi/2', 'pi', '3pi/2', '2pi'])
+        for tag in ['top', 'right']:
+            plt.gca().spines[tag].set_visible(False)
+        plt.title(titles[ii+1])
+        plt.xlabel('Theta Phase (rads)')
+
+    outname = os.path.join(config['figdir'], 'emd_supp1_maskjitter.png')
+    plt.savefig(outname, dpi=300, transparent=True)
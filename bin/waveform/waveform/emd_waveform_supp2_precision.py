@@ -0,0 +1,117 @@
+#!/usr/bin/python
+
+# vim: set expandtab ts=4 sw=4:
+
+#%% -----------------------------------------------------
+#
+# This script validates the float32 precision mode of the analysis (see
+# config['dtype'] in emd_waveform_utils.py). A segment of one recording is
+# analysed in both float64 and float32 and the metrics of cycles found at both
+# precisions are compared. The comparison is printed and saved into the
+# analysis directory.
+
+
+#%% -----------------------------------------------------
+# Imports and definitions
+
+
+import os
+import emd
+import logging
+import numpy as np
+import pandas
+
+from emd_waveform_utils import (config, load_dataset, cached_mask_sift,
+                                blockwise_frequency_transform)
+from emd_waveform_0_analysis import theta_cycles
+
+
+def run_precision(raw, speed, sample_rate, sift_config, dtype):
+    """Run the cycle analysis of one segment at a given precision.
+
+    Returns the metrics of all cycles, the phase-aligned waveforms of the
+    included cycles and the size in bytes of the time-series outputs.
+    """
+    logger = logging.getLogger('emd')
+    logger.info('STARTING: analysis in {0}'.format(dtype))
+
+    imf, mf = cached_mask_sift(raw.astype(dtype), sift_config)
+    IP, IF, IA = blockwise_frequency_transform(imf[:, 5], sample_rate, smooth_phase=3, dtype=dtype)
+    C = theta_cycles(imf[:, 5], IP, IF, IA, speed.astype(dtype))
+
+    df = C.get_metric_dataframe()
+    df['in_subset'] = np.asarray(C.subset_vect) > -1
+    pa, phasex = emd.cycles.phase_align(IP, IF, C.iterate(through='subset'))
+
+    # Size of the imf, IP, IF and IA arrays of all IMFs in the full analysis
+    return df, pa, 4 * imf.nbytes
+
+
+def compare_metrics(df64, df32):
+    """Compare the metrics of cycles which start on the same sample."""
+    both = df64.merge(df32, on='start_sample', suffixes=('_64', '_32'))
+
+    rows = []
+    for metric in df64.columns:
+        if metric in ('start_sample', 'in_subset') or metric + '_32' not in both:
+            continue
+        x64 = both[metric + '_64'].values.astype(float)
+        x32 = both[metric + '_32'].values.astype(float)
+        diff = np.abs(x64 - x32)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rel = diff / np.abs(x64)
+        rows.append({'metric': metric,
+                     'max_abs_diff': np.nanmax(diff),
+                     'median_abs_diff': np.nanmedian(diff),
+                     'max_rel_diff': np.nanmax(rel[np.isfinite(rel)]) if np.any(np.isfinite(rel)) else np.nan,
+                     'nan_mismatch': np.sum(np.isnan(x64) != np.isnan(x32))})
+    report = pandas.DataFrame(rows).set_index('metric')
+
+    summary = {'cycles_64': len(df64), 'cycles_32': len(df32), 'cycles_matched': len(both),
+               'subset_64': int(df64['in_subset'].sum()), 'subset_32': int(df32['in_subset'].sum()),
+               'subset_mismatch': int(np.sum(both['in_subset_64'] != both['in_subset_32']))}
+    return report, summary
+
+
+#%% ----------------------------------------------------
+# Main analysis
+
+
+if __name__ == '__main__':
+
+    run = 2
+    run_name = config['recordings'][run]
+    seconds = 600
+
+    logfile = os.path.join(config['analysisdir'], run_name+'_precision.log')
+    emd.logger.set_up(prefix=run_name, log_file=logfile)
+    logger = logging.getLogger('emd')
+
+    logger.info('STARTING: {0}'.format(run_name))
+
+    raw, speed, time, sample_rate = load_dataset(run_name, stop=seconds*1250, dtype='float64')
+
+    # Load sift specification
+    conf_file = os.path.join(config['basedir'], 'emd_masksift_CA1_config.yml')
+    sift_config = emd.sift.SiftConfig.from_yaml_file(conf_file)
+
+    df64, pa64, nbytes64 = run_precision(raw, speed, sample_rate, sift_config, 'float64')
+    df32, pa32, nbytes32 = run_precision(raw, speed, sample_rate, sift_config, 'float32')
+
+    report, summary = compare_metrics(df64, df32)
+    if pa64.shape == pa32.shape:
+        summary['pa_max_abs_diff'] = np.nanmax(np.abs(pa64 - pa32))
+    summary['nbytes_64'] = nbytes64
+    summary['nbytes_32'] = nbytes32
+
+    pandas.set_option('display.width', 120)
+    print(report)
+    for key, val in summary.items():
+        print('{0}: {1}'.format(key, val))
+
+    outfile = os.path.join(config['analysisdir'], run_name + '_precision.csv')
+    logger.info('Saving precision report to: {0}'.format(outfile))
+    report.to_csv(outfile)
+    with open(outfile[:-4] + '_summary.txt', 'w') as f:
+        for key, val in summary.items():
+            f.write('{0}: {1}\n'.format(key, val))
@@ -1,25 +1,107 @@
 import os
 import emd
+import json
+import h5py
+import time
+import hashlib
 import logging
+import resource
+import contextlib
 import numpy as np
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
-from scipy import ndimage, interpolate
+from scipy import ndimage
 
 # NEUROPY custom imports
-from src.config import BASE_DIR, DATA_DIR
-from src.utils import BaseIO
-baseio = BaseIO.get_baseio()
+from src.config import BASE_DIR
+
+
+def _week_results_dir():
+    """Results folder of the first week in the NeuroPy schedule"""
+    # BaseIO reads the schedule with pandas so is only imported when needed
+    from src.utils import BaseIO
+    return BaseIO.get_baseio().week_folders[1] / "results"
+
+
+class Config(dict):
+    """Analysis settings with folders and recordings resolved on first use.
+
+    Folder paths are checked (and made if necessary) the first time they are
+    accessed and the data files of a recording are only located when that
+    recording is requested, eg config['mdm81-2311-0128_2']['eeg']. Scripts
+    which only use simulated data therefore never touch the data directory.
+    """
+
+    # Folders used inside basedir when a path is not specified
+    default_dirs = {'figdir': 'figures', 'analysisdir': 'analysis', 'datadir': 'data'}
+
+    def __init__(self, paths):
+        super().__init__()
+        self.paths = paths
+
+    def __missing__(self, key):
+        if key in self.paths:
+            self[key] = self._resolve_dir(key)
+        elif key in self.get('recordings', []):
+            self[key] = self._find_recording(key)
+        else:
+            raise KeyError(key)
+        return dict.__getitem__(self, key)
+
+    def _resolve_dir(self, key):
+        path = self.paths[key]
+        if callable(path):
+            path = path()
+
+        if key == 'basedir':
+            if os.path.isdir(path) is False:
+                msg = "Study base directory not found! {0}/".format(path)
+                msg += "\nPlease specify or check the basedir defined in the emd_waveform_utils.py"
+                raise RuntimeError(msg)
+        elif path is None:
+            path = os.path.join(self['basedir'], self.default_dirs[key])
+            if os.path.isdir(path) is False:
+                if key == 'datadir':
+                    msg = "Specified data directory not found! {0}/".format(self['basedir'])
+                    msg += "\nPlease specify or check the datadir defined in the emd_waveform_utils.py"
+                    raise RuntimeError(msg)
+                # Make figures or analysis directory inside basedir if undefined
+                os.mkdir(path)
+        elif os.path.isdir(path) is False:
+            # Don't just make a new directory if user has specified one
+            msg = "Specified {0} directory not found! {1}/".format(key, path)
+            msg += "\nPlease specify or check the {0} defined in the emd_waveform_utils.py".format(key)
+            raise RuntimeError(msg)
+        return path
+
+    def _find_recording(self, rec):
+        D = {}
+        eeg = os.path.join(self['datadir'], rec[:-2], rec + '.eeg')
+        if os.path.isfile(eeg):
+            D['eeg'] = eeg
+        else:
+            raise RuntimeError('EEG datafile for {0} is missing! ({1})'.format(rec, eeg))
+
+        whl = os.path.join(self['datadir'], rec[:-2], rec + '.whl')
+        if os.path.isfile(whl):
+            D['whl'] = whl
+        else:
+            raise RuntimeError('whl datafile for {0} is missing! ({1})'.format(rec, whl))
+        return D
+
 
 # Please specify the following folder paths in this dictionary.
 #   figdir, datadir and analysisdir are optional. If unspecified, the code will
 #   look for them within the specified basedir. If a different directory is
-#   specified then it will be used.
+#   specified then it will be used. A function returning the path may also be
+#   given, it is called when the folder is first needed.
 
-#config = {'basedir':'/local/path/to/Quinn2021_waveform/',
-config = {'basedir': BASE_DIR,
-          'figdir': baseio.week_folders[1] / "results",
-          'datadir': None,
-          'analysisdir': None}
+#config = Config({'basedir':'/local/path/to/Quinn2021_waveform/',
+config = Config({'basedir': BASE_DIR,
+                 'figdir': _week_results_dir,
+                 'datadir': None,
+                 'analysisdir': None})
 
 # -----------------------------------------------------------------
 
@@ -37,73 +119,604 @@ config['recordings'] = ['mdm81-2311-0128_2',
 
 config['tetrode_inds'] = [25, 25, 9, 9, 33, 33]
 
+# Layout of the raw .eeg files - interleaved int16 samples from 64 channels
+config['nchannels'] = 64
+config['sample_rate'] = 1250
 
-def initialise():
+# Number of worker processes used when analysing several recordings or sift
+# runs at once. Note that each mask sift may also start 'nprocesses' workers
+# of its own as set in emd_masksift_CA1_config.yml
+config['nworkers'] = 1
 
-    if os.path.isdir(config['basedir']) is False:
-        msg = "Study base directory not found! {0}/".format(config['basedir'])
-        msg += "\nPlease specify or check the basedir defined in the emd_waveform_utils.py"
-        raise RuntimeError(msg)
-
-    # Check figure directory is defined and make it if not
-    if config['figdir'] is None:
-        config['figdir'] = os.path.join(config['basedir'], 'figures')
-        # Make figures directory inside basedir if undefined
-        if os.path.isdir(config['figdir']) is False:
-            os.mkdir(config['figdir'])
-    elif os.path.isdir(config['figdir']) is False:
-        # Don't just make a new directory if user has specified one
-        msg = "Specified figdir directory not found! {0}/".format(config['basedir'])
-        msg += "\nPlease specify or check the figdir defined in the emd_waveform_utils.py"
-        raise RuntimeError(msg)
-
-    # Check analysis directory is defined and make it if not
-    if config['analysisdir'] is None:
-        config['analysisdir'] = os.path.join(config['basedir'], 'analysis')
-        # Make figures directory inside basedir if undefined
-        if os.path.isdir(config['analysisdir']) is False:
-            os.mkdir(config['analysisdir'])
-    elif os.path.isdir(config['analysisdir']) is False:
-        # Don't just make a new directory if user has specified one
-        msg = "Specified analysisdir directory not found! {0}/".format(config['basedir'])
-        msg += "\nPlease specify or check the analysisdir defined in the emd_waveform_utils.py"
-        raise RuntimeError(msg)
-
-    # Check data directory exists and data is in the right place inside.
-    if config['datadir'] is None:
-        config['datadir'] = os.path.join(config['basedir'], 'data')
-        # Make figures directory inside basedir if undefined
-        if os.path.isdir(config['datadir']) is False:
-            msg = "Specified data directory not found! {0}/".format(config['basedir'])
-            msg += "\nPlease specify or check the datadir defined in the emd_waveform_utils.py"
-            raise RuntimeError(msg)
+# Maximum total size in bytes of the mask-sift cache kept in analysisdir. The
+# least recently used entries are removed once this is exceeded.
+config['sift_cache_size'] = 10 * 1024**3
 
+# Storage of the HDF5 analysis outputs. Time-series are chunked along time,
+# per-cycle arrays along cycles. Compression may be 'gzip', 'lzf' or None.
+config['hdf5_compression'] = 'gzip'
+config['hdf5_chunk_samples'] = 1250 * 8
+config['hdf5_chunk_cycles'] = 1024
+
+# Long frequency transforms are computed in blocks of samples, each padded by
+# neighbouring data on both sides to avoid edge effects from the Hilbert
+# transform. Blocks are a whole number of HDF5 time chunks.
+config['transform_block_samples'] = config['hdf5_chunk_samples'] * 32
+config['transform_pad_samples'] = 1250 * 16
+
+# Precision of the loaded data and all stored outputs, 'float64' or 'float32'.
+# The sift and the Hilbert transform are always computed in float64 and their
+# results cast to this type as the unwrapped phase of a long recording is too
+# large to be held accurately in float32.
+config['dtype'] = 'float64'
+
+
+
+def initialise():
+    """Resolve all folders and check every recording is present"""
+    for key in config.paths:
+        config[key]
     for rec in config['recordings']:
-        eeg = os.path.join(config['datadir'], rec[:-2], rec + '.eeg')
-        D = {}
-        if os.path.isfile(eeg):
-            D['eeg'] = eeg
-        else:
-            raise RuntimeError('EEG datafile for {0} is missing! ({1})'.format(rec, eeg))
+        config[rec]
+    return config
 
-        whl = os.path.join(config['datadir'], rec[:-2], rec + '.whl')
-        if os.path.isfile(whl):
-            D['whl'] = whl
+
+# -----------------------------------------------------------------
+
+
+def run_parallel(func, jobs, nworkers=None):
+    """Run func on each tuple of arguments in jobs, using a process pool if
+    more than one worker is requested. Results are returned in job order."""
+    if nworkers is None:
+        nworkers = config['nworkers']
+
+    if nworkers == 1 or len(jobs) < 2:
+        return [func(*args) for args in jobs]
+
+    with ProcessPoolExecutor(max_workers=min(nworkers, len(jobs))) as pool:
+        futures = [pool.submit(func, *args) for args in jobs]
+        return [f.result() for f in futures]
+
+
+# Timings of the stages run in this process, see timed_stage
+stage_timings = []
+
+
+def _usage():
+    """Return the CPU time of this process, the CPU time of its child processes
+    which have exited and the peak resident memory of this process in bytes.
+
+    Child processes which are still running, such as the persistent workers
+    started by the sift, are not included.
+    """
+    me = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in kilobytes on linux
+    return (me.ru_utime + me.ru_stime, children.ru_utime + children.ru_stime,
+            me.ru_maxrss * 1024)
+
+
+@contextlib.contextmanager
+def timed_stage(name):
+    """Log the wall time, CPU time and increase in peak memory of a stage.
+
+    CPU time and memory are those of the main process only. The CPU time of
+    worker processes which exit during the stage is recorded separately and
+    that of workers which are still running is not counted at all.
+
+    Use as a context manager, `with timed_stage('sift'):`, or as a function
+    decorator, `@timed_stage('sift')`. Each stage is also added to
+    stage_timings so that a summary can be saved with save_stage_timings.
+    """
+    logger = logging.getLogger('emd')
+    cpu0, child0, rss0 = _usage()
+    tic = time.perf_counter()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - tic
+        cpu1, child1, rss1 = _usage()
+        stage_timings.append({'stage': name, 'wall_time': wall,
+                              'main_cpu_time': cpu1 - cpu0,
+                              'exited_workers_cpu_time': child1 - child0,
+                              'main_peak_rss': rss1, 'main_peak_rss_delta': rss1 - rss0})
+        msg = ('Stage {0}: {1:.2f}s wall, {2:.2f}s main process CPU (+{3:.2f}s exited workers), '
+               'main process peak memory +{4:.1f}MB')
+        logger.info(msg.format(name, wall, cpu1 - cpu0, child1 - child0, (rss1 - rss0) / 1024**2))
+
+
+def save_stage_timings(outfile, **info):
+    """Save the stage timings recorded so far to a JSON file along with any
+    extra info, then clear them ready for the next run."""
+    summary = dict(info)
+    summary['total_wall_time'] = sum(t['wall_time'] for t in stage_timings)
+    summary['stages'] = list(stage_timings)
+    with open(outfile, 'w') as f:
+        json.dump(summary, f, indent=2)
+    stage_timings.clear()
+
+
+class SharedArrays:
+    """Publish arrays once in shared memory for use by worker processes.
+
+    Pass `specs` to the workers in place of the arrays themselves and call
+    attach_shared_arrays(specs) inside each worker to get zero-copy views,
+    rather than each job receiving its own pickled copy of the data. The
+    shared memory is released by close() or on leaving a with block.
+
+    Jobs run in this process, as with a single worker, attach to the blocks
+    created here rather than mapping them a second time.
+    """
+
+    def __init__(self, **arrays):
+        self._blocks = []
+        self.specs = {}
+        for name, arr in arrays.items():
+            arr = np.ascontiguousarray(arr)
+            shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+            np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+            self._blocks.append(shm)
+            self.specs[name] = (shm.name, arr.shape, arr.dtype.str)
+            _attached_blocks[shm.name] = shm
+
+    def close(self):
+        for shm in self._blocks:
+            _attached_blocks.pop(shm.name, None)
+            shm.unlink()
+            try:
+                shm.close()
+            except BufferError:
+                # Views of the block are still in use in this process, its
+                # memory is released once they are garbage collected
+                pass
+        self._blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Shared memory blocks published or attached in this process by name. Blocks
+# published here are removed by SharedArrays.close, those attached by a worker
+# are kept until the worker exits.
+_attached_blocks = {}
+
+
+def attach_shared_arrays(specs):
+    """Return read-only views of arrays published with SharedArrays."""
+    arrays = {}
+    for name, (shm_name, shape, dtype) in specs.items():
+        if shm_name not in _attached_blocks:
+            _attached_blocks[shm_name] = shared_memory.SharedMemory(name=shm_name)
+        arr = np.ndarray(shape, dtype=dtype, buffer=_attached_blocks[shm_name].buf)
+        arr.flags.writeable = False
+        arrays[name] = arr
+    return arrays
+
+
+def _sift_options(sift_config):
+    """Serialise the sift options which affect its output."""
+    opts = {key: sift_config[key] for key in sift_config
+            if key not in ('nprocesses', 'ret_mask_freq')}
+    return json.dumps(opts, sort_keys=True, default=lambda x: np.asarray(x).tolist())
+
+
+def _sift_cache_key(X, sift_config):
+    """Hash an input array and the sift options which affect its output."""
+    opts = _sift_options(sift_config)
+
+    X = np.ascontiguousarray(X)
+    h = hashlib.sha1()
+    h.update('{0} {1} {2}'.format(X.dtype, X.shape, emd.__version__).encode())
+    h.update(opts.encode())
+    h.update(X.data)
+    return h.hexdigest()
+
+
+def _prune_sift_cache(cachedir, max_size):
+    """Remove least recently used cache entries until under max_size bytes.
+
+    Temporary files still being written by other processes are left alone, and
+    entries removed by another process while pruning are skipped.
+    """
+    entries = []
+    for f in os.listdir(cachedir):
+        if f.endswith('.npz') is False or f.endswith('.tmp.npz'):
+            continue
+        try:
+            st = os.stat(os.path.join(cachedir, f))
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime, st.st_size, os.path.join(cachedir, f)))
+    entries = sorted(entries)
+
+    total = sum(size for mtime, size, f in entries)
+    while total > max_size and len(entries) > 0:
+        mtime, size, oldest = entries.pop(0)
+        total -= size
+        try:
+            os.remove(oldest)
+        except FileNotFoundError:
+            pass
+
+
+def cached_mask_sift(X, sift_config):
+    """Run emd.sift.mask_sift, reusing the result of any previous run on the
+    same data with the same options. Results are cached in analysisdir.
+
+    The sift is run in float64 and the IMFs are returned with the precision of
+    X (float64 for integer input)."""
+    logger = logging.getLogger('emd')
+
+    cachedir = os.path.join(config['analysisdir'], 'sift_cache')
+    if os.path.isdir(cachedir) is False:
+        os.makedirs(cachedir, exist_ok=True)
+
+    cachefile = os.path.join(cachedir, _sift_cache_key(X, sift_config) + '.npz')
+    ret_mask_freq = sift_config.get('ret_mask_freq', False)
+
+    if os.path.isfile(cachefile):
+        logger.info('Loading cached sift from: {0}'.format(cachefile))
+        with np.load(cachefile) as cached:
+            imf, mf = cached['imf'], cached['mask_freqs']
+        # Touch the entry so that it is treated as recently used
+        os.utime(cachefile)
+    else:
+        opts = {key: sift_config[key] for key in sift_config if key != 'ret_mask_freq'}
+        imf, mf = emd.sift.mask_sift(np.asarray(X, dtype=float), ret_mask_freq=True, **opts)
+        if np.issubdtype(X.dtype, np.floating):
+            imf = imf.astype(np.result_type(X.dtype, np.float32), copy=False)
+
+        logger.info('Saving sift to cache: {0}'.format(cachefile))
+        tmpfile = cachefile[:-4] + '.{0}.tmp.npz'.format(os.getpid())
+        np.savez(tmpfile, imf=imf, mask_freqs=mf)
+        os.replace(tmpfile, cachefile)
+        _prune_sift_cache(cachedir, config['sift_cache_size'])
+
+    if ret_mask_freq:
+        return imf, mf
+    return imf
+
+
+# Analysis outputs with time along the first axis, all others are stored with
+# cycles along the last axis.
+TIMESERIES_KEYS = ('imf', 'IP', 'IF', 'IA', 'speed')
+
+
+def _hdf5_storage_opts(key, shape, compression):
+    """Return the chunking and compression options for one output array."""
+    if len(shape) == 0 or np.prod(shape) == 0:
+        return {}
+
+    chunks = list(shape)
+    if key in TIMESERIES_KEYS:
+        chunks[0] = min(config['hdf5_chunk_samples'], shape[0])
+    else:
+        chunks[-1] = min(config['hdf5_chunk_cycles'], shape[-1])
+    opts = {'chunks': tuple(chunks)}
+
+    if compression == 'gzip':
+        opts.update({'compression': 'gzip', 'compression_opts': 4, 'shuffle': True})
+    elif compression == 'lzf':
+        opts.update({'compression': 'lzf', 'shuffle': True})
+    elif compression is not None:
+        raise ValueError("Unknown HDF5 compression '{0}' - use 'gzip', 'lzf' or None".format(compression))
+
+    return opts
+
+
+def save_analysis(outfile, outputs, compression='default', mode='w', dtype=None):
+    """Save a dictionary of analysis outputs to a chunked and compressed HDF5
+    file. Use mode='a' to add the outputs to an existing file. Floating point
+    outputs are stored as dtype, by default config['dtype']."""
+    if compression == 'default':
+        compression = config['hdf5_compression']
+    if dtype is None:
+        dtype = config['dtype']
+
+    with h5py.File(outfile, mode) as out:
+        for key, data in outputs.items():
+            data = np.asarray(data)
+            if np.issubdtype(data.dtype, np.floating):
+                data = data.astype(dtype, copy=False)
+            if key in out:
+                del out[key]
+            out.create_dataset(key, data=data, **_hdf5_storage_opts(key, data.shape, compression))
+
+
+def blockwise_frequency_transform(imf, sample_rate, outfile=None, smooth_phase=3,
+                                  block_samples=None, pad_samples=None,
+                                  compression='default', dtype=None):
+    """Compute the Hilbert frequency transform of imf one block at a time.
+
+    Each block is transformed together with pad_samples of the neighbouring
+    data on either side, which is then discarded, so that the result matches
+    a transform of the whole array up to the small residual edge effects of
+    the Hilbert transform. imf may be an array or a dataset from AnalysisFile.
+
+    If outfile is given IP, IF and IA are added to that HDF5 file as each
+    block is finished so that memory use does not grow with the length of the
+    recording. Otherwise the three arrays are returned. Each block is computed
+    in float64 and stored as dtype, by default config['dtype'].
+    """
+    logger = logging.getLogger('emd')
+    if block_samples is None:
+        block_samples = config['transform_block_samples']
+    if pad_samples is None:
+        pad_samples = config['transform_pad_samples']
+    if compression == 'default':
+        compression = config['hdf5_compression']
+    if dtype is None:
+        dtype = config['dtype']
+
+    nsamples = imf.shape[0]
+    shape = (nsamples,) + tuple(imf.shape[1:])
+    logger.info('Computing frequency transform of {0} samples in blocks of {1}'.format(nsamples, block_samples))
+
+    out = None
+    if outfile is None:
+        outputs = {key: np.empty(shape, dtype=dtype) for key in ('IP', 'IF', 'IA')}
+    else:
+        out = h5py.File(outfile, 'a')
+        outputs = {}
+        for key in ('IP', 'IF', 'IA'):
+            if key in out:
+                del out[key]
+            outputs[key] = out.create_dataset(key, shape=shape, dtype=dtype,
+                                              **_hdf5_storage_opts(key, shape, compression))
+
+    try:
+        for bstart in range(0, nsamples, block_samples):
+            bstop = min(bstart + block_samples, nsamples)
+            pstart = max(bstart - pad_samples, 0)
+            pstop = min(bstop + pad_samples, nsamples)
+
+            block = np.asarray(imf[pstart:pstop], dtype=float)
+            IP, IF, IA = emd.spectra.frequency_transform(block, sample_rate, 'hilbert',
+                                                         smooth_phase=smooth_phase)
+            keep = slice(bstart - pstart, bstop - pstart)
+            for key, data in zip(('IP', 'IF', 'IA'), (IP, IF, IA)):
+                outputs[key][bstart:bstop] = data[keep].reshape((bstop - bstart,) + shape[1:])
+    finally:
+        if out is not None:
+            out.close()
+
+    if outfile is None:
+        return outputs['IP'], outputs['IF'], outputs['IA']
+
+
+def save_channel_outputs(out, ind, outputs, nchannels, compression='default'):
+    """Write the outputs of one channel into an open HDF5 file.
+
+    Each output is stored with channels along an extra last axis of length
+    nchannels. Datasets are created on the first write and chunked one channel
+    at a time so that channels can be written in any order. Outputs smaller
+    than an existing dataset, such as a sift with fewer IMFs, are NaN padded.
+    """
+    if compression == 'default':
+        compression = config['hdf5_compression']
+
+    for key, data in outputs.items():
+        data = np.asarray(data)
+        if key not in out:
+            shape = data.shape + (nchannels,)
+            opts = _hdf5_storage_opts(key, shape, compression)
+            if 'chunks' in opts:
+                opts['chunks'] = opts['chunks'][:-1] + (1,)
+            out.create_dataset(key, shape=shape, dtype=data.dtype, fillvalue=np.nan, **opts)
+        dset = out[key]
+
+        if np.any(np.array(data.shape) > np.array(dset.shape[:-1])):
+            msg = "Output '{0}' of shape {1} does not fit dataset of shape {2}"
+            raise ValueError(msg.format(key, data.shape, dset.shape))
+        dset[tuple(slice(0, n) for n in data.shape) + (ind,)] = data
+
+
+def code_version(*paths):
+    """Hash the source of this module, the given files and the emd version."""
+    h = hashlib.sha1(emd.__version__.encode())
+    for path in (__file__,) + paths:
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def analysis_inputs(run_name, sift_config, *paths):
+    """Describe everything the analysis of a recording depends on.
+
+    This includes the size and modification time of the data files, the sift
+    options, the channel and precision used and the version of the code in
+    this module and in paths.
+    """
+    info = recording_manifest([run_name])[run_name]
+    inds = config['recordings'].index(run_name)
+    return {'eeg': info['eeg_stamp'],
+            'whl': info['whl_stamp'],
+            'channel': int(config['tetrode_inds'][inds]),
+            'sift_config': hashlib.sha1(_sift_options(sift_config).encode()).hexdigest(),
+            'dtype': config['dtype'],
+            'code_version': code_version(*paths)}
+
+
+def save_analysis_inputs(outfile, inputs):
+    """Store the inputs of an analysis in the attributes of its HDF5 output.
+    This should be done last so that it marks the outputs as complete."""
+    with h5py.File(outfile, 'a') as F:
+        F.attrs['inputs'] = json.dumps(inputs, sort_keys=True)
+
+
+def analysis_is_current(outfile, inputs):
+    """Return True if outfile was saved by a complete analysis of the same inputs."""
+    if os.path.isfile(outfile) is False:
+        return False
+    try:
+        with h5py.File(outfile, 'r') as F:
+            saved = F.attrs.get('inputs')
+    except OSError:
+        return False
+    return saved == json.dumps(inputs, sort_keys=True)
+
+
+def load_analysis(infile, keys=None, start=None, stop=None):
+    """Load outputs from an analysis HDF5 file.
+
+    Time-series outputs are restricted to samples start:stop so that only the
+    chunks covering that window are read and decompressed. Per-cycle outputs
+    are always loaded in full. A single key returns an array, a list of keys
+    (or None for all keys) returns a dictionary.
+    """
+    with h5py.File(infile, 'r') as F:
+        if isinstance(keys, str):
+            return _load_analysis_key(F, keys, start, stop)
+        if keys is None:
+            keys = list(F.keys())
+        return {key: _load_analysis_key(F, key, start, stop) for key in keys}
+
+
+def _load_analysis_key(F, key, start, stop):
+    if key in TIMESERIES_KEYS:
+        return F[key][start:stop, ...]
+    return F[key][...]
+
+
+class LazyDataset:
+    """Array-like view of an HDF5 dataset which only reads the indexed rows.
+
+    Indexing with integer arrays, slices or scalars along the first axis reads
+    the bounding range of rows from disk and applies the remaining indices in
+    memory, so x[inds, 5] materialises only the plotted window.
+    """
+
+    def __init__(self, dset):
+        self.dset = dset
+
+    @property
+    def shape(self):
+        return self.dset.shape
+
+    @property
+    def ndim(self):
+        return self.dset.ndim
+
+    @property
+    def dtype(self):
+        return self.dset.dtype
+
+    def __len__(self):
+        return self.dset.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.dset[...], dtype=dtype)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        rows, rest = key[0], key[1:]
+
+        if rows is Ellipsis:
+            return self.dset[...][key]
+
+        if isinstance(rows, slice) and rows.step in (None, 1):
+            start, stop, _ = rows.indices(self.shape[0])
+            block_rows, local = slice(start, max(start, stop)), slice(None)
+        elif isinstance(rows, (int, np.integer)):
+            row = rows + self.shape[0] if rows < 0 else rows
+            block_rows, local = slice(row, row + 1), 0
         else:
-            raise RuntimeError('whl datafile for {0} is missing! ({1})'.format(rec, whl))
-        config[rec] = D
+            if isinstance(rows, slice):
+                rows = np.arange(*rows.indices(self.shape[0]))
+            rows = np.asarray(rows)
+            if rows.dtype == bool:
+                rows = np.where(rows)[0]
+            rows = np.where(rows < 0, rows + self.shape[0], rows).astype(int)
+            lo = rows.min() if rows.size > 0 else 0
+            hi = rows.max() + 1 if rows.size > 0 else 0
+            block_rows, local = slice(lo, hi), rows - lo
 
-    return config
+        # h5py can apply integer and slice indices on the remaining axes itself
+        if all(isinstance(k, (int, np.integer, slice)) for k in rest):
+            return self.dset[(block_rows,) + rest][local]
+        return self.dset[block_rows][(local,) + rest]
 
-config = initialise()
 
+class AnalysisFile:
+    """Read-only access to an analysis HDF5 file returning LazyDatasets."""
 
-# -----------------------------------------------------------------
+    def __init__(self, infile):
+        self.infile = infile
+        self.F = h5py.File(infile, 'r')
+
+    def __getitem__(self, key):
+        return LazyDataset(self.F[key])
+
+    def keys(self):
+        return self.F.keys()
+
+    def close(self):
+        self.F.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_whl(whl_path):
+    """Read raw position samples from a .whl file.
+
+    The text is parsed once with the pandas C parser and cached in a .npy
+    sidecar next to the .whl file. Later reads memory-map the sidecar unless
+    the .whl file has been modified since it was written.
+    """
+    logger = logging.getLogger('emd')
+    sidecar = whl_path + '.npy'
+    if os.path.isfile(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(whl_path):
+        return np.load(sidecar, mmap_mode='r')
+
+    import pandas as pd
+    track = pd.read_csv(whl_path, sep=r'\s+', header=None, dtype=float, engine='c').values
+
+    try:
+        tmpfile = sidecar + '.{0}.tmp'.format(os.getpid())
+        with open(tmpfile, 'wb') as f:
+            np.save(f, track)
+        os.replace(tmpfile, sidecar)
+    except OSError as e:
+        logger.warning('Unable to cache tracking data in {0} ({1})'.format(sidecar, e))
+
+    return track
+
+
+def upsample_nearest(x, new_len, src_rate, dst_rate, start=0, stop=None):
+    """Nearest-neighbour upsampling of x onto a faster sample grid.
 
+    Equivalent to interp1d(kind='nearest', bounds_error=False) from
+    linspace(0, len(x)/src_rate, len(x)) onto linspace(0, new_len/dst_rate,
+    new_len) but computed as an integer index into x. Only samples start:stop
+    of the upsampled signal are computed so that long recordings can be
+    resampled one window or chunk at a time. Samples past the end of x are NaN.
+    """
+    x = np.asarray(x)
+    stop = new_len if stop is None else min(stop, new_len)
+    src_step = (x.shape[0] / src_rate) / max(x.shape[0] - 1, 1)
+    dst_step = (new_len / dst_rate) / max(new_len - 1, 1)
 
-def load_tracking(whl_path, new_len, smoothing=1):
+    t = np.arange(start, stop) * dst_step
+    # Ties are rounded down to match interp1d
+    inds = np.ceil(t / src_step - .5).astype(int)
+    valid = t <= (x.shape[0] - 1) * src_step
+
+    out = np.zeros((stop - start,) + x.shape[1:]) * np.nan
+    out[valid] = x[inds[valid]]
+    return out
+
+
+def load_tracking(whl_path, new_len, smoothing=1, start=0, stop=None):
     """Load position data from .whl file"""
-    track = np.genfromtxt( whl_path )
+    track = np.array(read_whl(whl_path), dtype=float)
     track[track<0] = np.nan
     if smoothing is not None:
             track = ndimage.filters.gaussian_filter1d(track, smoothing, axis=0)
@@ -115,27 +728,263 @@ def load_tracking(whl_path, new_len, smoothing=1):
 
     # Upsample to match LFP data
     factor = 1250/32
-    f = interpolate.interp1d( np.linspace(0,track.shape[0]/factor,track.shape[0]), speed,
-                       kind='nearest', bounds_error=False)
-    big_speed= f( np.linspace(0,new_len/1250, new_len) )*pixels2bins
+    big_speed = upsample_nearest(speed, new_len, factor, 1250, start=start, stop=stop)*pixels2bins
 
     return big_speed
 
 
-def load_dataset(run_id):
+class TimeAxis:
+    """Lazily evaluated time vector for a window of a recording.
+
+    Equivalent to np.linspace(0, nsamples/sample_rate, nsamples) + offset
+    but values are only computed when indexed or converted to an array.
+    """
+
+    def __init__(self, nsamples, sample_rate, offset=0):
+        self.nsamples = nsamples
+        self.sample_rate = sample_rate
+        self.offset = offset
+        self.step = (nsamples / sample_rate) / max(nsamples - 1, 1)
+
+    @property
+    def shape(self):
+        return (self.nsamples,)
+
+    def __len__(self):
+        return self.nsamples
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            inds = np.arange(*key.indices(self.nsamples))
+        else:
+            inds = np.arange(self.nsamples)[key]
+        return inds * self.step + self.offset
+
+    def __array__(self, dtype=None, copy=None):
+        out = np.arange(self.nsamples) * self.step + self.offset
+        return out if dtype is None else out.astype(dtype)
+
+
+def get_eeg_nsamples(eeg_path, nchannels=64):
+    """Return the number of samples in a multiplexed int16 .eeg file"""
+    return os.path.getsize(eeg_path) // (np.dtype(np.int16).itemsize * nchannels)
+
+
+def load_eeg(eeg_path, channels, start=0, stop=None, nchannels=64,
+             block_samples=2**16, nsamples=None, dtype=float):
+    """Load a subset of channels and samples from a multiplexed .eeg file.
+
+    The file is memory-mapped one block of samples at a time so that only the
+    requested channels are converted to float and peak memory scales with the
+    size of the output rather than the size of the file. nsamples may be given
+    (eg from the recording manifest) to avoid checking the file size.
+    """
+    itemsize = np.dtype(np.int16).itemsize
+    if nsamples is None:
+        nsamples = get_eeg_nsamples(eeg_path, nchannels)
+    stop = nsamples if stop is None else min(stop, nsamples)
+    if start < 0 or start >= stop:
+        raise ValueError('Invalid sample range ({0}, {1}) for {2} samples'.format(start, stop, nsamples))
+
+    out = np.empty((stop - start, np.size(channels)), dtype=dtype)
+    for bstart in range(start, stop, block_samples):
+        bstop = min(bstart + block_samples, stop)
+        block = np.memmap(eeg_path, dtype=np.int16, mode='r',
+                          offset=bstart * nchannels * itemsize,
+                          shape=(bstop - bstart, nchannels))
+        out[bstart - start:bstop - start, :] = block[:, np.atleast_1d(channels)]
+        del block
+
+    if np.ndim(channels) == 0:
+        out = out[:, 0]
+    return out
+
+
+# Metadata of each recording is kept in a manifest in the analysis directory so
+# that jobs can be planned and loads checked without opening the raw files.
+MANIFEST_NAME = 'recordings_manifest.json'
+
+
+def _file_stamp(path):
+    st = os.stat(path)
+    return {'mtime': st.st_mtime, 'size': st.st_size}
+
+
+def _describe_recording(rec):
+    """Collect the manifest entry of one recording from its data files"""
+    eeg, whl = config[rec]['eeg'], config[rec]['whl']
+    dtype = np.dtype(np.int16)
+    eeg_stamp = _file_stamp(eeg)
+    if eeg_stamp['size'] % (dtype.itemsize * config['nchannels']) != 0:
+        msg = 'EEG datafile for {0} is not a whole number of {1} channel samples ({2})'
+        raise RuntimeError(msg.format(rec, config['nchannels'], eeg))
+    nsamples = eeg_stamp['size'] // (dtype.itemsize * config['nchannels'])
+
+    return {'eeg': eeg, 'eeg_stamp': eeg_stamp,
+            'whl': whl, 'whl_stamp': _file_stamp(whl),
+            'nchannels': config['nchannels'],
+            'dtype': dtype.str,
+            'sample_rate': config['sample_rate'],
+            'nsamples': nsamples,
+            'duration': nsamples / config['sample_rate'],
+            'tracking_samples': read_whl(whl).shape[0]}
+
+
+def recording_manifest(recordings=None):
+    """Return the manifest entries of the requested recordings.
+
+    Entries are cached in MANIFEST_NAME inside analysisdir and recomputed if
+    either data file has moved or changed size or modification time since they
+    were written.
+    """
+    logger = logging.getLogger('emd')
+    if recordings is None:
+        recordings = config['recordings']
+
+    manifest_file = os.path.join(config['analysisdir'], MANIFEST_NAME)
+    manifest = {}
+    if os.path.isfile(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+
+    changed = False
+    for rec in recordings:
+        entry = manifest.get(rec)
+        if (entry is None or entry['nchannels'] != config['nchannels'] or
+                entry['eeg'] != config[rec]['eeg'] or entry['whl'] != config[rec]['whl'] or
+                entry['eeg_stamp'] != _file_stamp(config[rec]['eeg']) or
+                entry['whl_stamp'] != _file_stamp(config[rec]['whl'])):
+            logger.info('Updating manifest entry for {0}'.format(rec))
+            manifest[rec] = _describe_recording(rec)
+            changed = True
+
+    if changed:
+        tmpfile = manifest_file + '.{0}.tmp'.format(os.getpid())
+        with open(tmpfile, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmpfile, manifest_file)
+
+    return {rec: manifest[rec] for rec in recordings}
+
+
+# Cycle outputs of all recordings are collected into a group store in the
+# analysis directory - a cycle table, a [cycles x phase] matrix of phase-aligned
+# instantaneous frequency and an index of where each recording starts.
+GROUP_TABLE = 'group_cycles.feather'
+GROUP_PA = 'group_pa.npy'
+GROUP_INDEX = 'group_index.json'
+
+
+def _group_sources(recordings):
+    sources = {}
+    for rec in recordings:
+        stem = os.path.join(config['analysisdir'], rec)
+        sources[rec] = {'csv': _file_stamp(stem + '.csv'), 'hdf5': _file_stamp(stem + '.hdf5')}
+    return sources
+
+
+def build_group_store(recordings=None):
+    """Collect the cycle metrics and phase-aligned IF of several recordings.
+
+    The per-recording csv files are stacked into one Feather table with the
+    recording index in a 'run' column and the phase-aligned IF are written
+    into one contiguous .npy matrix with a row per cycle in the same order.
+    The index file is written last so that it marks the store as complete.
+    """
+    import pandas as pd
+    logger = logging.getLogger('emd')
+    if recordings is None:
+        recordings = config['recordings']
+
+    tables = []
+    for run, rec in enumerate(recordings):
+        df = pd.read_csv(os.path.join(config['analysisdir'], rec + '.csv'), index_col=0)
+        df = df.reset_index(drop=True)
+        df.insert(0, 'run', run)
+        tables.append(df)
+    starts = np.r_[0, np.cumsum([len(df) for df in tables])]
+
+    pafile = os.path.join(config['analysisdir'], GROUP_PA)
+    logger.info('Saving group phase-aligned IF to: {0}'.format(pafile))
+    tmpfile = pafile[:-4] + '.{0}.tmp.npy'.format(os.getpid())
+    pa = None
+    for run, rec in enumerate(recordings):
+        with AnalysisFile(os.path.join(config['analysisdir'], rec + '.hdf5')) as F:
+            run_pa = np.asarray(F['pa']).T
+        if run_pa.shape[0] != len(tables[run]):
+            msg = 'Recording {0} has {1} phase-aligned cycles but {2} rows in its csv'
+            raise RuntimeError(msg.format(rec, run_pa.shape[0], len(tables[run])))
+        if pa is None:
+            pa = np.lib.format.open_memmap(tmpfile, mode='w+', dtype=run_pa.dtype,
+                                           shape=(int(starts[-1]), run_pa.shape[1]))
+        pa[starts[run]:starts[run+1], :] = run_pa
+    pa.flush()
+    del pa
+    os.replace(tmpfile, pafile)
+
+    tablefile = os.path.join(config['analysisdir'], GROUP_TABLE)
+    logger.info('Saving group cycle table to: {0}'.format(tablefile))
+    tmpfile = tablefile + '.{0}.tmp'.format(os.getpid())
+    pd.concat(tables, ignore_index=True).to_feather(tmpfile)
+    os.replace(tmpfile, tablefile)
+
+    index = {'recordings': list(recordings),
+             'starts': starts[:-1].tolist(),
+             'stops': starts[1:].tolist(),
+             'sources': _group_sources(recordings)}
+    with open(os.path.join(config['analysisdir'], GROUP_INDEX), 'w') as f:
+        json.dump(index, f, indent=2)
+    return index
+
+
+def load_group_store(recordings=None):
+    """Load the group cycle table and phase-aligned IF of several recordings.
+
+    Returns the cycle table, a memory-mapped [cycles x phase] matrix of
+    phase-aligned IF and the index giving the rows of each recording. The
+    store is rebuilt first if it is missing or any recording has been
+    reanalysed since it was made.
+    """
+    import pandas as pd
+    if recordings is None:
+        recordings = config['recordings']
+
+    indexfile = os.path.join(config['analysisdir'], GROUP_INDEX)
+    index = None
+    if os.path.isfile(indexfile):
+        with open(indexfile) as f:
+            index = json.load(f)
+    if (index is None or index['recordings'] != list(recordings) or
+            index['sources'] != _group_sources(recordings)):
+        index = build_group_store(recordings)
+
+    df = pd.read_feather(os.path.join(config['analysisdir'], GROUP_TABLE))
+    pa = np.load(os.path.join(config['analysisdir'], GROUP_PA), mmap_mode='r')
+    return df, pa, index
+
+
+def load_dataset(run_id, start=0, stop=None, channels=None, dtype=None):
     logger = logging.getLogger('emd')
+    if dtype is None:
+        dtype = config['dtype']
 
     inds = np.where([r == run_id for r in config['recordings']])[0][0]
+    if channels is None:
+        channels = config['tetrode_inds'][inds]
 
-    logger.info('Loading data from: {0}'.format(config[run_id]['eeg']))
-    raw = np.fromfile(config[run_id]['eeg'], dtype=np.int16).astype(float)
-    raw = raw.reshape(-1,64)[:,config['tetrode_inds'][inds]]
-    sample_rate = 1250
+    info = recording_manifest([run_id])[run_id]
+    logger.info('Loading data from: {0}'.format(info['eeg']))
+    raw = load_eeg(info['eeg'], channels, start=start, stop=stop,
+                   nchannels=info['nchannels'], nsamples=info['nsamples'], dtype=dtype)
+    sample_rate = info['sample_rate']
     seconds = raw.shape[0] / sample_rate
-    time = np.linspace(0,seconds,raw.shape[0])
+    time = TimeAxis(raw.shape[0], sample_rate, offset=start / sample_rate)
     logger.info('Loaded {0} seconds of data'.format(seconds))
 
-    logger.info('Loading tracking from: {0}'.format(config[run_id]['whl']))
-    speed = load_tracking(config[run_id]['whl'], time.shape[0], smoothing=16)
+    logger.info('Loading tracking from: {0}'.format(info['whl']))
+    # Speed is kept as float if the raw samples are loaded as integers
+    speed_dtype = dtype if np.issubdtype(dtype, np.floating) else float
+    speed = load_tracking(info['whl'], info['nsamples'], smoothing=16,
+                          start=start, stop=start + raw.shape[0]).astype(speed_dtype)
 
     return raw, speed, time, sample_rate